@@ -0,0 +1,238 @@
+"""
+Compressed file input and output for usage data, StackScores and annotations.
+
+Outputs may be written with one of several codecs:
+
+  gzip - stdlib gzip (default)
+  pigz - gzip compatible output written by a multithreaded pigz process
+  zstd - Zstandard, needs the zstandard module
+  lz4  - LZ4 frames, needs the lz4 module
+
+If the program or module needed for a codec isn't available then output falls
+back to gzip with a warning. Inputs are opened by sniffing the magic bytes at the
+start of the file so any of these (or an uncompressed file) can be read without
+configuration.
+"""
+
+import gzip
+import logging
+import os
+import subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODECS = ('gzip', 'pigz', 'zstd', 'lz4')
+
+EXTENSIONS = {'gzip': '.gz', 'pigz': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+
+DEFAULT_LEVELS = {'gzip': 9, 'pigz': 9, 'zstd': 3, 'lz4': 0}
+
+MAGIC = (('\x1f\x8b', 'gzip'),
+         ('\x28\xb5\x2f\xfd', 'zstd'),
+         ('\x04\x22\x4d\x18', 'lz4'))
+
+
+def extension_codec(filename):
+    """Codec implied by extension of filename, None if not recognized"""
+    if (filename.endswith('.gz')):
+        return 'gzip'
+    elif (filename.endswith('.zst')):
+        return 'zstd'
+    elif (filename.endswith('.lz4')):
+        return 'lz4'
+    return None
+
+
+def codec_for_filename(filename):
+    """Codec implied by extension of filename, gzip if not recognized"""
+    return extension_codec(filename) or 'gzip'
+
+
+def find_program(name):
+    """Return full path of executable name on PATH, else None"""
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        program = os.path.join(path, name)
+        if (os.path.isfile(program) and os.access(program, os.X_OK)):
+            return program
+    return None
+
+
+def available_codec(codec):
+    """Return codec if it can be used here, else 'gzip' after warning"""
+    if ((codec == 'pigz' and find_program('pigz') is None) or
+        (codec == 'zstd' and zstandard is None) or
+        (codec == 'lz4' and lz4 is None)):
+        logging.warning("Compression codec %s not available, using gzip" % (codec))
+        return 'gzip'
+    return codec
+
+
+class PipeWriter(object):
+    """
+    Class providing file-like write to compressed file through an external
+    compression program that reads stdin and writes stdout
+    """
+
+    def __init__(self, filename, cmd):
+        self.name = filename
+        self.cmd = cmd
+        self.out = open(filename, 'wb')
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.out)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        returncode = self.proc.wait()
+        self.out.close()
+        if (returncode != 0):
+            raise Exception("Compression of %s failed, %s exited with %d" % (self.name, self.cmd[0], returncode))
+
+
+class ZstdWriter(object):
+    """Class providing file-like write to Zstandard compressed file"""
+
+    def __init__(self, filename, level, threads=0):
+        self.name = filename
+        self.out = open(filename, 'wb')
+        cctx = zstandard.ZstdCompressor(level=level, threads=threads)
+        self.writer = cctx.stream_writer(self.out)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+        self.out.close()
+
+
+class StreamReader(object):
+    """
+    Class providing line oriented file-like reading over a decompressing stream
+    that supports only read(size)
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, filename, stream, fh=None):
+        self.name = filename
+        self.stream = stream
+        self.fh = fh
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Add next chunk from stream to buffer, return False at end of stream"""
+        if (self.eof):
+            return False
+        data = self.stream.read(self.chunk_size)
+        if (not data):
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        while ((size < 0 or len(self.buffer) - self.pos < size) and self.fill()):
+            pass
+        if (size < 0):
+            size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        start = self.pos
+        while True:
+            end = self.buffer.find('\n', start)
+            if (end >= 0):
+                return self.read(end + 1 - self.pos)
+            start = len(self.buffer) - self.pos
+            if (not self.fill()):
+                return self.read()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if (line == ''):
+            raise StopIteration
+        return line
+
+    __next__ = next
+
+    def close(self):
+        self.stream.close()
+        if (self.fh is not None):
+            self.fh.close()
+
+
+def open_output(filename, codec=None, level=None, threads=0):
+    """Open filename for compressed writing
+
+    codec defaults to that implied by the filename extension, level to the
+    default level for the codec (9 for gzip as for gzip.open). threads is used
+    by the pigz and zstd codecs, 0 for pigz means one per CPU and for zstd
+    means single-threaded. Warns if the codec actually used (after any fallback
+    to gzip) doesn't match a recognized filename extension, callers that choose
+    the filename should use available_codec() first and take the extension from
+    EXTENSIONS.
+    """
+    codec = available_codec(codec or codec_for_filename(filename))
+    ext_codec = extension_codec(filename)
+    if (ext_codec is not None and EXTENSIONS[ext_codec] != EXTENSIONS[codec]):
+        logging.warning("Writing %s compressed data to %s" % (codec, filename))
+    if (level is None):
+        level = DEFAULT_LEVELS[codec]
+    if (codec == 'pigz'):
+        cmd = [find_program('pigz'), '-%d' % (level), '-c']
+        if (threads):
+            cmd[2:2] = ['-p', str(threads)]
+        return PipeWriter(filename, cmd)
+    elif (codec == 'zstd'):
+        return ZstdWriter(filename, level, threads)
+    elif (codec == 'lz4'):
+        return lz4.frame.open(filename, 'wb', compression_level=level)
+    return gzip.open(filename, 'wb', level)
+
+
+def sniff_codec(filename):
+    """Codec for filename from magic bytes at start, None if not recognized"""
+    fh = open(filename, 'rb')
+    start = fh.read(4)
+    fh.close()
+    for (magic, codec) in MAGIC:
+        if (start.startswith(magic)):
+            return codec
+    return None
+
+
+def open_input(filename):
+    """Open filename for reading, decompressing according to the codec sniffed
+
+    Files that are not recognized as compressed are opened as plain files.
+    """
+    codec = sniff_codec(filename)
+    if (codec == 'gzip'):
+        return gzip.open(filename, 'rb')
+    elif (codec == 'zstd'):
+        if (zstandard is None):
+            raise Exception("Cannot read Zstandard compressed %s without zstandard module" % (filename))
+        fh = open(filename, 'rb')
+        return StreamReader(filename, zstandard.ZstdDecompressor().stream_reader(fh), fh)
+    elif (codec == 'lz4'):
+        if (lz4 is None):
+            raise Exception("Cannot read LZ4 compressed %s without lz4 module" % (filename))
+        return StreamReader(filename, lz4.frame.open(filename, 'rb'))
+    return open(filename, 'rb')
@@ -3,59 +3,67 @@
 
 Usage:
 
-> cumulative_dist.dat
-simeon@RottenApple ld4l-cul-usage>git mv cumulative_dist.dat reference_dist.dat
 simeon@RottenApple ld4l-cul-usage>./make_reference_dist.py analysis/harvard_stackscore_distribution.dat  > reference_dist.dat 
 simeon@RottenApple ld4l-cul-usage>head reference_dist.dat 
 # Reference distribution over StackScore 1..100
 # (derived from distribution in analysis/harvard_stackscore_distribution.dat)
 #
 #stackscore fraction
-10.98078307
-20.00551701
-30.00350775
-40.00177471
-50.00128962
-60.00095700
+1	0.98078307
+2	0.00551701
+3	0.00350775
+4	0.00177471
+5	0.00128962
+6	0.00095700
+
+Several source distributions may be blended, with --weights to weight them
+other than equally, and the result smoothed over StackScores 2..100 with
+--smooth. With --output, --cache-dir and one or more --total-items the
+cumulative target counts used for normalization are also written to the
+cache directory for parse_cul_usage_data.py --reference-cache.
 """
+import logging
+import optparse
 import sys
 
-def read_dist(file):
-    """Read in a distribution
-
-    # Distribution of StackScore values at Harvard, 2015-06-24
-    #
-    #record_count     stackscore        fraction_of_records
-    13560805        1       0.98078307
-    76281   2       0.00551701
-    48500   3       0.00350775
-    24538   4       0.00177471
-    ...
-    140     100     0.00001013
-    """
-    fh = open(file, 'r')
-    dist = {}
-    total = 0
-    for line in fh.readlines():
-        if (line.startswith('#')):
-            continue
-        (count,stackscore,frac) = line.split()
-        count = int(count)
-        stackscore = int(stackscore)
-        if (stackscore<1 or stackscore>100):
-            raise Exception("Stackscore out of range in: %s" % line)
-        dist[stackscore] = count
-        total += count
-    return(dist,total)
-
-
-dfile = sys.argv[1]
-(dist,total) = read_dist(dfile)
-cumulative = 0
-print "# Reference distribution over StackScore 1..100"
-print "# (derived from distribution in %s)" % (dfile)
-print "#\n#stackscore fraction"
-for ss in xrange(1,101):
-    print "%d\t%.8f" % (ss,float(dist[ss])/total)
+import stackscore_reference
 
+p = optparse.OptionParser(description='Make reference StackScore distribution',
+                          usage='usage: %prog [[opts]] source_dist1.dat [source_dist2.dat ...]')
+p.add_option('--weights', action='store',
+             help="Comma separated weights for blending source distributions (default equal)")
+p.add_option('--smooth', action='store', type='int', default=0,
+             help="Window for moving average smoothing over StackScores 2..100 (default no smoothing)")
+p.add_option('--output', '-o', action='store',
+             help="Write reference distribution to file instead of STDOUT")
+p.add_option('--cache-dir', action='store',
+             help="Directory to write cumulative reference targets to, needs --output")
+p.add_option('--total-items', action='append', type='int', default=[],
+             help="Total number of items to write cumulative reference targets for (repeatable)")
+(opt, dfiles) = p.parse_args()
 
+logging.basicConfig(level=logging.INFO)
+if (len(dfiles)==0):
+    p.error("No source distributions specified")
+if (opt.cache_dir and not opt.output):
+    p.error("--cache-dir needs --output")
+weights = None
+if (opt.weights):
+    weights = [float(w) for w in opt.weights.split(',')]
+fractions = stackscore_reference.blend_dists([stackscore_reference.read_source_dist(f) for f in dfiles], weights)
+if (len(dfiles)==1):
+    description = ["(derived from distribution in %s)" % (dfiles[0])]
+else:
+    description = ["(derived from distributions in %s)" % (', '.join(
+        ["%s weight %g" % (f,w) for (f, w) in zip(dfiles, weights or [1.0]*len(dfiles))]))]
+if (opt.smooth):
+    fractions = stackscore_reference.smooth_dist(fractions, opt.smooth)
+    description.append("(smoothed over StackScores 2..100 with window %d)" % (opt.smooth))
+fh = open(opt.output, 'w') if (opt.output) else sys.stdout
+stackscore_reference.write_reference_dist(fractions, fh, description)
+if (opt.output):
+    fh.close()
+if (opt.cache_dir):
+    dist = stackscore_reference.read_reference_dist(opt.output, opt.cache_dir)
+    for total_items in opt.total_items:
+        dist.targets(total_items)
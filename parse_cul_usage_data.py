@@ -3,39 +3,184 @@
 # Code to parse CUL usage data, do some analysis, and generate
 # a StackScore. See README.md.
 #
+import array
+import bisect
+import copy
 import datetime
-import gzip
+import itertools
 import logging
+import multiprocessing
 import optparse
 import os
 from random import SystemRandom
 import re
+import shutil
 import sys
+import tempfile
 import math
 import numpy
 
+import compressed_io
+import stackscore_reference
+
 class SkipLine(Exception):
     """Exception to indicate skipping certain types of line without adding to bad count or flagging"""
     pass
 
+class IdRangeError(Exception):
+    """Exception for ids that can't be recorded, aborts reading rather than counting as a bad line"""
+    pass
+
+class HyperLogLog(object):
+    """
+    Class to estimate number of distinct integers added using HyperLogLog
+    with 2^p registers, standard error about 1.04/sqrt(2^p)
+
+    Integers are added in numpy arrays so that hashing and register updates
+    are vectorized.
+    """
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = numpy.zeros(self.m, dtype=numpy.int64)
+
+    @staticmethod
+    def hash64(x):
+        """Mix uint64 array x into 64 bit hashes (splitmix64 finalizer)"""
+        x = x + numpy.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        return x ^ (x >> numpy.uint64(31))
+
+    def add_array(self, values):
+        """Add all integers in numpy array values"""
+        if (len(values)==0):
+            return
+        h = self.hash64(values.astype(numpy.uint64))
+        index = (h >> numpy.uint64(64 - self.p)).astype(numpy.int64)
+        # rank is position of first 1 bit in the remaining 64-p bits, these are
+        # exact as float64 so frexp() gives their bit length
+        rest = (h & numpy.uint64((1 << (64 - self.p)) - 1)).astype(numpy.float64)
+        rank = (64 - self.p) - numpy.frexp(rest)[1] + 1
+        # keep highest rank for each register, last of each index once sorted
+        keys = numpy.unique(index * 64 + rank)
+        index = keys // 64
+        last = numpy.append(index[1:] != index[:-1], True)
+        index = index[last]
+        self.registers[index] = numpy.maximum(self.registers[index], keys[last] % 64)
+
+    def __len__(self):
+        """Estimated number of distinct integers added"""
+        alpha = 0.7213 / (1.0 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / numpy.power(2.0, -self.registers).sum()
+        zeros = numpy.count_nonzero(self.registers==0)
+        if (estimate <= 2.5 * self.m and zeros > 0):
+            # small range correction using linear counting
+            estimate = self.m * math.log(float(self.m) / zeros)
+        return int(round(estimate))
+
+
 class LineIterator(object):
     """
     Class to encapsulate iteration over lines with up to max_bad ignored before error
+
+    By default only the numbers of distinct bib_ids and item_ids seen are estimated
+    using HyperLogLog, ids are buffered in arrays and added compact_size at a time.
+    If track_items is set then each (item_id, bib_id) pair seen is recorded along
+    with the values named in item_values for each line, and the item_id to bib_id
+    mapping with count of lines and sums of values for each pair is available from
+    item_map(). Pairs are packed into 64-bit keys (item_id << 32) | bib_id so when
+    tracking items item_id must be in [0, 2^31) and bib_id in [0, 2^32), ids out
+    of range raise IdRangeError.
     """
-    def __init__(self, file, data=''):
+    compact_size = 1000000
+    item_values = ()
+
+    def __init__(self, file, data='', track_items=False):
         self.linenum = 0
         self.max_bad = 10;
-        self.fh = gzip.open(file,'rb')
+        self.fh = compressed_io.open_input(file)
         logging.info("Reading %sfrom %s" % (data,file))
-        self.bib_ids = set()
-        self.item_ids = set()
+        self.track_items = track_items
+        if (track_items):
+            self.pairs = array.array('l')
+            self.values = [array.array('l') for name in self.item_values]
+            self.pair_keys = numpy.zeros(0, dtype=numpy.int64)
+            self.pair_counts = numpy.zeros(0, dtype=numpy.int64)
+            self.pair_values = [numpy.zeros(0, dtype=numpy.int64) for name in self.item_values]
+        else:
+            self.bib_buffer = array.array('l')
+            self.item_buffer = array.array('l')
+            self.bib_ids = HyperLogLog()
+            self.item_ids = HyperLogLog()
+
+    def record(self, item_id, bib_id, *values):
+        """Record item_id and bib_id seen in current line, with item_values if tracking items"""
+        if (self.track_items):
+            if (item_id < 0 or item_id >= 2**31 or bib_id < 0 or bib_id >= 2**32):
+                raise IdRangeError("[%s line %d] Can't track item_id %d with bib_id %d, need 0 <= item_id < 2^31 and 0 <= bib_id < 2^32" % (self.fh.name,self.linenum,item_id,bib_id))
+            self.pairs.append((item_id << 32) | bib_id)
+            for (buffer, value) in zip(self.values, values):
+                buffer.append(value)
+            if (len(self.pairs) >= self.compact_size):
+                self.compact()
+        else:
+            self.bib_buffer.append(bib_id)
+            self.item_buffer.append(item_id)
+            if (len(self.bib_buffer) >= self.compact_size):
+                self.compact()
+
+    def compact(self):
+        """Merge buffered ids into HyperLogLog estimators, or buffered pairs into item map
+
+        With track_items the pairs are merged into sorted unique pair_keys with counts
+        of lines in pair_counts and sums of each of item_values in the arrays in
+        pair_values.
+        """
+        if (not self.track_items):
+            self.bib_ids.add_array(numpy.frombuffer(self.bib_buffer, dtype=numpy.int64))
+            self.item_ids.add_array(numpy.frombuffer(self.item_buffer, dtype=numpy.int64))
+            self.bib_buffer = array.array('l')
+            self.item_buffer = array.array('l')
+            return
+        if (len(self.pairs)==0):
+            return
+        keys = numpy.concatenate((self.pair_keys, numpy.frombuffer(self.pairs, dtype=numpy.int64)))
+        counts = numpy.concatenate((self.pair_counts, numpy.ones(len(self.pairs), dtype=numpy.int64)))
+        values = [numpy.concatenate((pair_values, numpy.frombuffer(buffer, dtype=numpy.int64)))
+                  for (pair_values, buffer) in zip(self.pair_values, self.values)]
+        (self.pair_keys, inverse) = numpy.unique(keys, return_inverse=True)
+        self.pair_counts = numpy.bincount(inverse, weights=counts).astype(numpy.int64)
+        self.pair_values = [numpy.bincount(inverse, weights=v, minlength=len(self.pair_keys)).astype(numpy.int64)
+                            for v in values]
+        self.pairs = array.array('l')
+        self.values = [array.array('l') for name in self.item_values]
+
+    def item_map(self):
+        """Return (item_ids, bib_ids, counts, values) arrays sorted by item_id then bib_id
+
+        There is one entry for each distinct (item_id, bib_id) pair seen, with the
+        number of lines with that pair in counts and a list of arrays in values with
+        the sums of each of item_values. An item_id appears more than once only if
+        it was seen with more than one bib_id.
+        """
+        if (not self.track_items):
+            raise Exception("Item mapping not available without track_items")
+        self.compact()
+        return(self.pair_keys >> 32, self.pair_keys & 0xFFFFFFFF, self.pair_counts, self.pair_values)
 
     @property
     def num_bib_ids(self):
+        if (self.track_items):
+            return len(numpy.unique(self.item_map()[1]))
+        self.compact()
         return len(self.bib_ids)
 
     @property
     def num_item_ids(self):
+        if (self.track_items):
+            return len(numpy.unique(self.item_map()[0]))
+        self.compact()
         return len(self.item_ids)
 
     def __iter__(self):
@@ -58,8 +203,8 @@ class LineIterator(object):
         while (attempt < self.max_bad):
             try:
                 return self.next_line()
-            except StopIteration as si:
-                raise si
+            except (StopIteration, IdRangeError):
+                raise
             except SkipLine:
                 # don't increment count of bad lines
                 pass
@@ -82,9 +227,10 @@ class CULChargeAndBrowse(LineIterator):
     4672    44857   8       5
     9001938 246202  0       0
     """
+    item_values = ('charges','browses')
 
-    def __init__(self, file):
-        super(CULChargeAndBrowse, self).__init__(file,'charge and browse counts ')
+    def __init__(self, file, track_items=False):
+        super(CULChargeAndBrowse, self).__init__(file,'charge and browse counts ',track_items)
         first_line = self.readline(keep_comment=True)
         if (first_line != '# CHARGE AND BROWSE COUNTS'):
             raise Exception("Bad format for circ data in %s, bad first line '%s'" % (file,first_line))
@@ -100,18 +246,17 @@ class CULChargeAndBrowse(LineIterator):
             (item_id,bib_id,charges,browses) = self.line.split()
             bib_id = int(bib_id)
             charges = int(charges)
-            self.bib_ids.add(bib_id)
-            self.item_ids.add(int(item_id))
             if (charges>10000):
                 raise Exception("excessive charge count: %d for bib_id=%d" % (charges,bib_id)) 
             browses = int(browses)
             if (browses>10000):
                 raise Exception("excessive browse count: %d for bib_id=%d" % (browses,bib_id)) 
+            self.record(int(item_id),bib_id,charges,browses)
             if (charges==0 and browses==0):
                 raise SkipLine()
             return (bib_id,charges,browses)
-        except SkipLine as sl:
-            raise sl
+        except (SkipLine, IdRangeError):
+            raise
         except Exception as e:
             # provide file ane line num details in msg
             raise Exception('[%s line %d] Ignoring "%s"] %s' % (self.fh.name,self.linenum,self.line,str(e)))
@@ -135,8 +280,8 @@ class CULCircTrans(LineIterator):
                 148                                     09-JUL-00
     """
                 
-    def __init__(self, file):
-        super(CULCircTrans,self).__init__(file,'circulation transactions ')
+    def __init__(self, file, track_items=False):
+        super(CULCircTrans,self).__init__(file,'circulation transactions ',track_items)
         first_line = self.readline(keep_comment=True)
         if (first_line != '# CIRCULATION TRANSACTIONS'):
             raise Exception("Bad format for circ data in %s, bad first line '%s'" % (file,first_line))
@@ -151,12 +296,11 @@ class CULCircTrans(LineIterator):
             # else try to parse for real
             (trans_id,item_id,bib_id,date) = self.line.split()
             bib_id = int(bib_id)
-            self.bib_ids.add(bib_id)
-            self.item_ids.add(int(item_id))
+            self.record(int(item_id),bib_id)
             date = datetime.datetime.strptime(date, "%d-%b-%y").date()
             return (bib_id,date)
-        except SkipLine as sl:
-            raise sl
+        except (SkipLine, IdRangeError):
+            raise
         except Exception as e:
             # provide file ane line num details in msg
             raise Exception('[%s line %d] Ignoring "%s"] %s' % (self.fh.name,self.linenum,self.line,str(e)))
@@ -164,6 +308,11 @@ class CULCircTrans(LineIterator):
         """Read next line else raise exception describing problem"""
         raise StopIteration
 
+def open_compressed_output(file):
+    """Open file for compressed output using the codec, level and threads in options"""
+    return compressed_io.open_output(file, opt.compression, opt.compression_level, opt.compression_threads)
+
+
 def make_randomized_subset(opt):
     """Make a subset dataset for fraction of the bib-ids"""
     bib_ids = {}
@@ -172,7 +321,7 @@ def make_randomized_subset(opt):
     r = SystemRandom() # a non-reporoducible random generator
 
     logging.warning("Writing subset charge and browse to %s..." % opt.subset_charge_and_browse )
-    cab_fh = gzip.open( opt.subset_charge_and_browse, 'w')
+    cab_fh = open_compressed_output(opt.subset_charge_and_browse)
     cab_fh.write("# CHARGE AND BROWSE COUNTS\n")
     cab_fh.write("# (randomized subset data, item_id=0)\n")
     fake_bib_ids = set()
@@ -189,7 +338,7 @@ def make_randomized_subset(opt):
     cab_fh.close()
 
     logging.warning("Writing subset circ trans to %s..." % opt.subset_circ_trans )
-    ct_fh = gzip.open( opt.subset_circ_trans, 'w')
+    ct_fh = open_compressed_output(opt.subset_circ_trans)
     ct_fh.write("# CIRCULATION TRANSACTIONS\n")
     ct_fh.write("# (randomized subset data, trans_id=0, item_id=0)\n")
     for (bib_id,date) in CULCircTrans(opt.circ_trans):
@@ -209,7 +358,11 @@ def make_randomized_subset(opt):
 def write_float_dist(data,file):
     """Write summary of distribution of floats to file"""
     hist, bin_edges = numpy.histogram(data.values(), bins=100)
-    total_bib_ids = len(data)
+    write_float_hist(hist, bin_edges, len(data), file)
+
+
+def write_float_hist(hist, bin_edges, total_bib_ids, file):
+    """Write binned distribution of floats, as from numpy.histogram(), to file"""
     logging.info("Writing summary distribution to %s..." % file)
     fh = open(file, 'w')
     fh.write("# Binned distribution %s\n#\n" % file)
@@ -244,6 +397,16 @@ def write_dist(data,file,all_bib_ids=0,extra_score_one=0):
                 else:
                     # default not to include specific example bib_id for individual data sources
                     example_bib_id[count] = '-'
+    write_dist_counts(num_bib_ids,example_bib_id,total_counts,file,all_bib_ids,extra_score_one)
+
+
+def write_dist_counts(num_bib_ids,example_bib_id,total_counts,file,all_bib_ids=0,extra_score_one=0):
+    """Write distribution to file given number of bib_ids and example bib_id for each count
+
+    num_bib_ids and example_bib_id are dicts keyed by int(count) and include only
+    non-zero counts, total_counts is the sum of all counts. See write_dist().
+    """
+    total_bib_ids = sum(num_bib_ids.values())
     if (extra_score_one>0):
         num_bib_ids[1] = num_bib_ids.get(1,0) + extra_score_one
         if (1 not in example_bib_id):
@@ -271,19 +434,25 @@ def write_dist(data,file,all_bib_ids=0,extra_score_one=0):
     fh.close()
 
 
-def write_stackscores(scores,file):
-    """Write individual StackScores to gzipped file
+def write_stackscores(scores,file,total=None):
+    """Write individual StackScores to compressed file
+
+    scores is either a dict of StackScore by bib_id, or an iterable of (bib_id,
+    StackScore) pairs in bib_id order in which case total must be given.
 
     Note that this data will include only bib_ids mentioned in the usage data. It 
     will not include extra bib_ids that are assigned StackScore 1.
     """
+    if (total is None):
+        total = len(scores)
+        scores = [(bib_id,scores[bib_id]) for bib_id in sorted(scores.keys())]
     logging.info("Writing StackScores to %s..." % file)
-    fh = gzip.open(file, 'w')
+    fh = open_compressed_output(file)
     fh.write("# StackScores by bib_id, %s\n#\n" % file)
-    fh.write("# total bib_ids = %d\n#\n" % len(scores))
+    fh.write("# total bib_ids = %d\n#\n" % total)
     fh.write("#bib_id\tStackScore\n")
-    for bib_id in sorted(scores.keys()):
-        fh.write("%d\t%d\n" % (bib_id,scores[bib_id]))
+    for (bib_id, stackscore) in scores:
+        fh.write("%d\t%d\n" % (bib_id,stackscore))
     fh.close()
 
 
@@ -344,8 +513,376 @@ def analyze_distributions(opt):
     fh.close()
 
 
-def compute_raw_scores(opt):
-    """Read in usage data and compute StackScores
+def read_usage_blocks(file, first_line, block_size=32*1024*1024):
+    """Read compressed usage data file in blocks of complete lines, yielding text of each block
+
+    Reads about block_size bytes at a time, checks the first line is first_line and
+    drops comment lines. Used for fast screening where each block is split and
+    converted to numpy arrays in one go rather than parsed line by line.
+    """
+    logging.info("Screening %s" % (file))
+    fh = compressed_io.open_input(file)
+    line = fh.readline().strip()
+    if (line != first_line):
+        raise Exception("Bad format for data in %s, bad first line '%s'" % (file,line))
+    rest = ''
+    while True:
+        data = fh.read(block_size)
+        if (not data):
+            break
+        data = rest + data
+        end = data.rfind('\n') + 1
+        rest = data[end:]
+        yield re.sub(r'(?m)^[ \t]*#.*\n', '', data[:end])
+    fh.close()
+    if (rest):
+        yield re.sub(r'^[ \t]*#.*', '', rest) + '\n'
+
+
+def split_block(text, ncols):
+    """Split block of lines into fields, return (fields, num_lines, num_malformed)
+
+    fields is a flat list of the fields of all lines with exactly ncols fields. The
+    whole block is split at once and the number of fields on each line is found
+    from the positions of field starts (non-whitespace after whitespace) and of
+    newlines, fields are only filtered individually if some lines have the wrong
+    number of fields.
+    """
+    if (not text):
+        return([], 0, 0)
+    # whitespace as for str.split(), space and \t\n\x0b\x0c\r
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    space = (chars==32) | ((chars>=9) & (chars<=13))
+    starts = numpy.flatnonzero(~space & numpy.concatenate(([True], space[:-1])))
+    ends = numpy.flatnonzero(chars==10)
+    if (chars[-1]!=10):
+        ends = numpy.append(ends, len(chars))
+    per_line = numpy.diff(numpy.concatenate(([0], numpy.searchsorted(starts, ends))))
+    fields = text.split()
+    good = (per_line==ncols)
+    if (good.all()):
+        return(fields, len(per_line), 0)
+    fields = list(itertools.compress(fields, numpy.repeat(good, per_line).tolist()))
+    return(fields, len(per_line), len(per_line)-numpy.count_nonzero(good))
+
+
+def int_columns(columns):
+    """Convert lists of integer strings, one per column, to (n,ncols) numpy array
+
+    Returns (array, good) where good is a boolean array marking the rows that
+    were all integers and so are included in array.
+    """
+    n = len(columns[0])
+    values = numpy.fromstring(' '.join([' '.join(c) for c in columns]), dtype=numpy.int64, sep=' ')
+    if (len(values) == n*len(columns) and (n==0 or values.min()>=0)):
+        return(values.reshape(len(columns),n).T, numpy.ones(n, dtype=bool))
+    good = numpy.array([all([c[j].isdigit() for c in columns]) for j in range(n)], dtype=bool)
+    values = numpy.array([[int(c[j]) for c in columns] for j in range(n) if good[j]], dtype=numpy.int64)
+    return(values.reshape(-1,len(columns)), good)
+
+
+def num_duplicate_rows(data):
+    """Number of rows of 2-d array data that duplicate an earlier row"""
+    if (len(data)==0):
+        return 0
+    return len(data)-len(numpy.unique(data, axis=0))
+
+
+def robust_z(values):
+    """Robust z-scores of values based on median and median absolute deviation"""
+    median = numpy.median(values)
+    mad = numpy.median(numpy.abs(values-median))
+    if (mad==0):
+        # fall back to mean absolute deviation, scaled to match MAD for normal data
+        mad = numpy.mean(numpy.abs(values-median)) / 1.2533
+    if (mad==0):
+        return numpy.zeros(len(values))
+    return 0.6745 * (values-median) / mad
+
+
+def count_outliers(name, bib_ids, counts, opt, report):
+    """Add to report robust z-score outliers in counts per bib_id, return their bib_ids
+
+    The z-scores are calculated for log(1+count) over bib_ids with non-zero counts
+    because the usage count distributions are very long tailed.
+    """
+    nonzero = counts>0
+    bib_ids = bib_ids[nonzero]
+    counts = counts[nonzero]
+    if (len(counts)==0):
+        return bib_ids
+    z = robust_z(numpy.log1p(counts))
+    outliers = numpy.nonzero(z>opt.screen_z)[0]
+    report.append("%d bib_ids with %s outliers (robust z > %.1f, out of %d bib_ids with %s)" % (len(outliers),name,opt.screen_z,len(counts),name))
+    for j in outliers[numpy.argsort(-z[outliers])][:10]:
+        report.append("    bib_id=%d %s=%d z=%.1f" % (bib_ids[j],name,counts[j],z[j]))
+    return bib_ids[outliers]
+
+
+def check_rate(name, num, total, opt, report, failures):
+    """Add rate of num out of total to report, and to failures if over opt.screen_max_rate"""
+    rate = float(num)/total if total else 0.0
+    report.append("%d %s out of %d (rate %.7f)" % (num,name,total,rate))
+    if (rate>opt.screen_max_rate):
+        failures.append("%s rate %.7f exceeds %g" % (name,rate,opt.screen_max_rate))
+
+
+def screen_charge_and_browse(file, opt, report, failures):
+    """Screen charge and browse counts in file, adding to report and failures"""
+    lines = 0
+    malformed = 0
+    blocks = []
+    for text in read_usage_blocks(file, '# CHARGE AND BROWSE COUNTS'):
+        (fields, num_lines, bad) = split_block(text, 4)
+        (block, good) = int_columns([fields[j::4] for j in range(4)])
+        lines += num_lines
+        malformed += bad + len(good) - numpy.count_nonzero(good)
+        blocks.append(block)
+    data = numpy.concatenate(blocks) if blocks else numpy.zeros((0,4), dtype=numpy.int64)
+    report.append("Charge and browse counts %s" % (file))
+    check_rate('malformed lines', malformed, lines, opt, report, failures)
+    check_rate('duplicate rows', num_duplicate_rows(data), len(data), opt, report, failures)
+    item_ids = data[:,0][data[:,0]!=0] # item_id 0 used in randomized subsets
+    check_rate('duplicate item_ids', len(item_ids)-len(numpy.unique(item_ids)), len(item_ids), opt, report, failures)
+    check_rate('counts over 10000', numpy.count_nonzero((data[:,2]>10000)|(data[:,3]>10000)), len(data), opt, report, failures)
+    (bib_ids, inverse) = numpy.unique(data[:,1], return_inverse=True)
+    outliers = numpy.zeros(0, dtype=numpy.int64)
+    for (col, name) in ((2,'charges'),(3,'browses')):
+        counts = numpy.bincount(inverse, weights=data[:,col], minlength=len(bib_ids)).astype(numpy.int64)
+        outliers = numpy.union1d(outliers, count_outliers(name, bib_ids, counts, opt, report))
+    check_rate('bib_ids with outlier counts', len(outliers), len(bib_ids), opt, report, failures)
+
+
+def screen_circ_trans(file, opt, report, failures):
+    """Screen circulation transactions in file, adding to report and failures"""
+    lines = 0
+    malformed = 0
+    no_bib_id = 0
+    blocks = []
+    date_blocks = []
+    for text in read_usage_blocks(file, '# CIRCULATION TRANSACTIONS'):
+        # lines with just trans_id and date have no bib_id and are ignored
+        (text, num_no_bib_id) = re.subn(r'(?m)^[ \t]*\d+[ \t]+\d\d-\w+-\d\d[ \t]*\n', '', text)
+        (fields, num_lines, bad) = split_block(text, 4)
+        (block, good) = int_columns([fields[j::4] for j in range(3)])
+        lines += num_lines + num_no_bib_id
+        no_bib_id += num_no_bib_id
+        malformed += bad + len(good) - numpy.count_nonzero(good)
+        blocks.append(block)
+        date_blocks.append(numpy.array(fields[3::4], dtype=str)[good])
+    data = numpy.concatenate(blocks) if blocks else numpy.zeros((0,3), dtype=numpy.int64)
+    dates = numpy.concatenate(date_blocks) if date_blocks else numpy.zeros(0, dtype=str)
+    # parse each distinct date string just once
+    (date_strs, inverse) = numpy.unique(dates, return_inverse=True)
+    ordinals = numpy.zeros(len(date_strs), dtype=numpy.int64)
+    for (j, date_str) in enumerate(date_strs):
+        try:
+            ordinals[j] = datetime.datetime.strptime(date_str, "%d-%b-%y").toordinal()
+        except ValueError:
+            ordinals[j] = -1
+    ordinals = ordinals[inverse]
+    bad_dates = (ordinals<0)
+    malformed += numpy.count_nonzero(bad_dates)
+    data = data[~bad_dates]
+    ordinals = ordinals[~bad_dates]
+    report.append("Circulation transactions %s" % (file))
+    check_rate('malformed lines', malformed, lines, opt, report, failures)
+    report.append("%d lines without bib_id (ignored)" % (no_bib_id))
+    if (len(ordinals)):
+        report.append("dates range from %s to %s" % (datetime.date.fromordinal(ordinals.min()),datetime.date.fromordinal(ordinals.max())))
+    earliest = opt.screen_earliest.toordinal()
+    latest = (opt.reference_date or datetime.datetime.now().date()).toordinal()
+    check_rate('dates before %s' % (opt.screen_earliest), numpy.count_nonzero(ordinals<earliest), len(ordinals), opt, report, failures)
+    check_rate('dates after %s' % (datetime.date.fromordinal(latest)), numpy.count_nonzero(ordinals>latest), len(ordinals), opt, report, failures)
+    # trans_id 0 used in randomized subsets where rows are not expected to be unique
+    with_trans_id = (data[:,0]!=0)
+    rows = numpy.column_stack((data, ordinals))[with_trans_id]
+    check_rate('duplicate rows', num_duplicate_rows(rows), len(rows), opt, report, failures)
+    trans_ids = data[:,0][with_trans_id]
+    check_rate('duplicate trans_ids', len(trans_ids)-len(numpy.unique(trans_ids)), len(trans_ids), opt, report, failures)
+    (bib_ids, counts) = numpy.unique(data[:,2], return_counts=True)
+    outliers = count_outliers('circ_trans', bib_ids, counts, opt, report)
+    check_rate('bib_ids with outlier counts', len(outliers), len(bib_ids), opt, report, failures)
+
+
+def screen_inputs(charge_and_browse, circ_trans, report_file, opt):
+    """Screen usage data inputs for bad data before scoring, return True if they pass
+
+    Reads both inputs a block at a time into numpy arrays and checks rates of
+    malformed lines, duplicate rows and ids, dates out of range, and bib_ids with
+    count outliers compared with the global distribution. Any rate over
+    opt.screen_max_rate is a failure. The report is written to report_file.
+    """
+    start = datetime.datetime.now()
+    report = []
+    failures = []
+    for (screen, file) in ((screen_charge_and_browse, charge_and_browse), (screen_circ_trans, circ_trans)):
+        file_failures = []
+        screen(file, opt, report, file_failures)
+        failures += ["%s: %s" % (file,failure) for failure in file_failures]
+    logging.info("Writing screening report to %s..." % (report_file))
+    fh = open(report_file,'w')
+    fh.write("# Screening of usage data (%.1fs)\n#\n" % ((datetime.datetime.now()-start).total_seconds()))
+    for line in report:
+        fh.write("%s\n" % (line))
+    fh.write("#\n%s\n" % ('FAILED' if failures else 'PASSED'))
+    for failure in failures:
+        fh.write("  %s\n" % (failure))
+        logging.error("Screening failed, %s" % (failure))
+    fh.close()
+    return(len(failures)==0)
+
+
+def period_index(date, period):
+    """Index of the month or year containing date, months counted from year 0"""
+    if (period=='year'):
+        return date.year
+    return date.year*12 + date.month-1
+
+
+def period_date(index, period):
+    """Representative date (middle) of the month or year with given period_index"""
+    if (period=='year'):
+        return datetime.date(index,7,1)
+    return datetime.date(index//12,index%12+1,15)
+
+
+def period_end(index, period):
+    """Last date of the month or year with given period_index"""
+    if (period=='year'):
+        return datetime.date(index,12,31)
+    return datetime.date((index+1)//12,(index+1)%12+1,1) - datetime.timedelta(days=1)
+
+
+def rollup_file(name):
+    """Name of circulation rollup file, name with .npz added if it doesn't end with that
+
+    This is the name numpy.savez_compressed() actually writes to, used for both
+    --make-circ-rollup and --circ-rollup so that they agree.
+    """
+    if (name.endswith('.npz')):
+        return name
+    return name + '.npz'
+
+
+def make_circ_rollup(opt):
+    """Aggregate circulation transactions into bib_id x period counts and write to disk
+
+    The rollup is a sparse count matrix stored as a compressed numpy .npz file with
+    arrays:
+
+    bib_ids - sorted distinct bib_ids
+    periods - sorted distinct period indexes (see period_index())
+    bib_idx, period_idx, counts - one entry for each non-zero cell of the matrix
+
+    The rollup is written to rollup_file(opt.make_circ_rollup). The rollup period is a month or a year
+    according to opt.rollup_period. Scores
+    for any reference date, halflife or window can then be computed from the rollup
+    by circ_rollup_scores() without re-reading the circulation transactions.
+    """
+    period = opt.rollup_period
+    bibs = array.array('l')
+    pers = array.array('l')
+    ct = CULCircTrans(opt.circ_trans)
+    for (bib_id,date) in ct:
+        bibs.append(bib_id)
+        pers.append(period_index(date,period))
+    logging.info("Found about %d bib_ids in circulation and transaction data" % (ct.num_bib_ids))
+    bibs = numpy.frombuffer(bibs, dtype=numpy.int64)
+    pers = numpy.frombuffer(pers, dtype=numpy.int64)
+    (bib_ids, bib_idx) = numpy.unique(bibs, return_inverse=True)
+    (periods, period_idx) = numpy.unique(pers, return_inverse=True)
+    # combine into one key per cell to count transactions in each cell
+    (cells, counts) = numpy.unique(bib_idx.astype(numpy.int64)*len(periods)+period_idx, return_counts=True)
+    file = rollup_file(opt.make_circ_rollup)
+    logging.info("Writing circulation rollup by %s with %d cells to %s..." % (period,len(cells),file))
+    numpy.savez_compressed(file,
+                           period=numpy.array(period),
+                           bib_ids=bib_ids,
+                           periods=periods.astype(numpy.int32),
+                           bib_idx=(cells//len(periods)).astype(numpy.int32),
+                           period_idx=(cells%len(periods)).astype(numpy.int32),
+                           counts=counts.astype(numpy.int32))
+
+
+def circ_rollup_scores(file, today, circ_weight, circ_halflife, window=0, latest=None):
+    """Compute decayed circulation scores from the rollup in file
+
+    Each period of the rollup is weighted as if all its transactions happened on
+    the period_date(), so ages are approximate to half a period and are taken as
+    zero for periods with period_date() after today. Periods more than window days
+    before today are ignored if window is non-zero. If latest is given then periods
+    that end after latest are ignored so that no later transactions are included,
+    latest should be the last day of a period to include all transactions up to
+    that date. Returns a dict of score by bib_id for all bib_ids with transactions
+    in the included periods.
+    """
+    file = rollup_file(file)
+    logging.info("Reading circulation rollup from %s..." % (file))
+    rollup = numpy.load(file)
+    period = str(rollup['period'])
+    periods = rollup['periods']
+    ages = numpy.array([max(0, (today - period_date(int(index),period)).days) for index in periods], dtype=numpy.float64)
+    weights = circ_weight * numpy.power(0.5, ages/circ_halflife)
+    included = numpy.ones(len(periods), dtype=bool)
+    if (window):
+        included &= (ages <= window)
+    if (latest is not None):
+        included &= numpy.array([period_end(int(index),period) <= latest for index in periods], dtype=bool)
+        if (period_end(period_index(latest,period),period) != latest):
+            logging.warning("Reference date %s is not the end of a %s, transactions in the %s containing it are excluded" % (latest,period,period))
+    weights[~included] = 0.0
+    bib_idx = rollup['bib_idx']
+    period_idx = rollup['period_idx']
+    counts = rollup['counts']
+    nbibs = len(rollup['bib_ids'])
+    circ = numpy.bincount(bib_idx, weights=counts*weights[period_idx], minlength=nbibs)
+    used = numpy.bincount(bib_idx, weights=counts*included[period_idx], minlength=nbibs) > 0
+    logging.info("Found %d bib_ids in circulation rollup, %d in included periods" % (nbibs,numpy.count_nonzero(used)))
+    return dict(zip(rollup['bib_ids'][used].tolist(), circ[used].tolist()))
+
+
+def write_item_report(cab, ct, opt):
+    """Write per-item usage report and summary of multi-item bib_ids to opt.item_report
+
+    cab and ct are the CULChargeAndBrowse and CULCircTrans readers, read with
+    track_items set, that collected the item_id to bib_id mappings while the usage
+    data was read for scoring. The report has one line for each (item_id, bib_id)
+    pair with the charges and browses and the number of circulation transactions
+    for that pair, and a header summarizing the number of bib_ids with more than
+    one item and item_ids mapped to more than one bib_id.
+    """
+    (cab_item_ids, cab_bib_ids, cab_lines, (cab_charges, cab_browses)) = cab.item_map()
+    (ct_item_ids, ct_bib_ids, ct_lines, ct_values) = ct.item_map()
+    cab_keys = (cab_item_ids << 32) | cab_bib_ids
+    ct_keys = (ct_item_ids << 32) | ct_bib_ids
+    keys = numpy.union1d(cab_keys, ct_keys)
+    charges = numpy.zeros(len(keys), dtype=numpy.int64)
+    browses = numpy.zeros(len(keys), dtype=numpy.int64)
+    circ = numpy.zeros(len(keys), dtype=numpy.int64)
+    charges[numpy.searchsorted(keys, cab_keys)] = cab_charges
+    browses[numpy.searchsorted(keys, cab_keys)] = cab_browses
+    circ[numpy.searchsorted(keys, ct_keys)] = ct_lines
+    item_ids = keys >> 32
+    bib_ids = keys & 0xFFFFFFFF
+    (items, items_per_item) = numpy.unique(item_ids, return_counts=True)
+    (bibs, items_per_bib) = numpy.unique(bib_ids, return_counts=True)
+    logging.info("Writing item report to %s..." % (opt.item_report))
+    fh = open(opt.item_report, 'w')
+    fh.write("# Items by bib_id from %s and %s\n#\n" % (opt.charge_and_browse,opt.circ_trans))
+    fh.write("# total item_ids = %d\n" % len(items))
+    fh.write("# total bib_ids = %d\n" % len(bibs))
+    fh.write("# bib_ids with more than one item_id = %d\n" % numpy.count_nonzero(items_per_bib>1))
+    fh.write("# item_ids with more than one bib_id = %d\n" % numpy.count_nonzero(items_per_item>1))
+    fh.write("# most item_ids for one bib_id = %d\n" % (items_per_bib.max() if len(bibs) else 0))
+    fh.write("#\n#item_id\tbib_id\tcharges\tbrowses\tcirc_trans\n")
+    for row in zip(item_ids.tolist(), bib_ids.tolist(), charges.tolist(), browses.tolist(), circ.tolist()):
+        fh.write("%d\t%d\t%d\t%d\t%d\n" % row)
+    fh.close()
+
+
+def raw_score_contributions(opt):
+    """Read in usage data and yield (bib_id, contribution) to raw scores
 
     Score is calculated according to:
 
@@ -357,57 +894,457 @@ def compute_raw_scores(opt):
     means that a circulation that happens today will score (charge_weight+circ_weight) whereas
     on the happened circ_halflife ago will score (charge_weight+0.5*circ_weight). An old 
     circulation event that is recored only in the charge counts will score just charge_weight.
+
+    Ages are calculated relative to opt.reference_date if given (and then circulation
+    transactions after that date are ignored), else relative to today. If opt.circ_window
+    is set then only circulation transactions in that number of years before the
+    reference date are included. If opt.circ_rollup is given then circulation data
+    is taken from that rollup (see make_circ_rollup()) instead of opt.circ_trans.
+
+    If opt.item_report is given then the item_id to bib_id mappings are tracked
+    as the data is read and the item report is written at the end (see
+    write_item_report()).
     """
-    scores = {}
     charge_weight = 2
     browse_weight = 1
     circ_weight = 2
-    circ_halflife =  5.0 * 365.0 # number of days back that circ trans has half circ_weight
+    circ_halflife =  opt.circ_halflife * 365.0 # number of days back that circ trans has half circ_weight
+    window = opt.circ_window * 365.0 # number of days back to include circ trans, 0 for all
 
-    cab = CULChargeAndBrowse(opt.charge_and_browse)
+    track_items = bool(opt.item_report)
+    cab = CULChargeAndBrowse(opt.charge_and_browse, track_items)
     for (bib_id,charges,browses) in cab:
         #print "%d %d %d" % (bib_id,charges,browses)
-        scores[bib_id] = scores.get(bib_id,0) + charges*charge_weight + browses*browse_weight
-    logging.info("Found %d bib_ids in charge and browse data" % (cab.num_bib_ids))
+        yield (bib_id, charges*charge_weight + browses*browse_weight)
+    logging.info("Found about %d bib_ids in charge and browse data" % (cab.num_bib_ids))
     
-    today = datetime.datetime.now().date()
-    ct = CULCircTrans(opt.circ_trans)
-    for (bib_id,date) in ct:
-        age = (today - date).days # age in years since circ transaction
-        score = circ_weight * math.pow(0.5, age/circ_halflife )
-        #print "%d %s %.3f %.3f" % (bib_id,str(date),age,score)
+    today = opt.reference_date or datetime.datetime.now().date()
+    if (opt.circ_rollup):
+        circ = circ_rollup_scores(opt.circ_rollup, today, circ_weight, circ_halflife, window, opt.reference_date)
+        for bib_id in circ:
+            yield (bib_id, circ[bib_id])
+    else:
+        ct = CULCircTrans(opt.circ_trans, track_items)
+        for (bib_id,date) in ct:
+            age = (today - date).days # age in years since circ transaction
+            if ((window and age>window) or (opt.reference_date and age<0)):
+                continue
+            score = circ_weight * math.pow(0.5, age/circ_halflife )
+            #print "%d %s %.3f %.3f" % (bib_id,str(date),age,score)
+            yield (bib_id, score)
+        logging.info("Found about %d bib_ids in circulation and transaction data" % (ct.num_bib_ids))
+        if (track_items):
+            write_item_report(cab, ct, opt)
+
+
+def compute_raw_scores(opt):
+    """Read in usage data and compute raw scores, see raw_score_contributions()"""
+    scores = {}
+    for (bib_id, score) in raw_score_contributions(opt):
         scores[bib_id] = scores.get(bib_id,0) + score
-    logging.info("Found %d bib_ids in circulation and transaction data" % (ct.num_bib_ids))
     write_float_dist(scores, opt.raw_scores_dist)
     return(scores)
 
 
-def read_reference_dist(file):
-    """Read reference distribution from file
+class ScoreRuns(object):
+    """
+    Class to sum (bib_id, contribution) pairs into raw scores out of core
 
-    File format has # for comment linesm then data:
+    Pairs are buffered in arrays until there are max_pairs, then sorted by bib_id,
+    summed per bib_id and spilled as a binary run file in a temporary directory
+    under tmpdir. merge() does a k-way merge of the runs into a single run with one
+    raw score per bib_id in bib_id order which can then be read back in chunks.
 
-    #stackscore fraction
-    100 0.00001013
-    99 0.00001013
-    98 0.00003045
-    ...
+    The record dtype gives the names and types of the key and value fields, with
+    typecodes for the arrays used to buffer them, so that subclasses can sum other
+    (key, value) pairs in the same way.
     """
-    logging.info("Reading reference distribution from %s..." % (file))
-    fh = open(file,'r')
-    dist = {}
-    total = 0.0
-    for line in fh:
-        if (re.match('^#',line)):
-            continue
-        (stackscore, fraction)= line.split()
-        fraction = float(fraction)
-        dist[int(stackscore)] = fraction
-        total += fraction
-        #print "%d %f" % (stackscore,fraction)
-    if (abs(1.0-total)>0.000001):
-        logging.warning("Expected distribution from %s to sum to 1.0, got %f" % (file,total))
-    return dist
+    dtype = numpy.dtype([('bib_id','<i8'),('score','<f8')])
+    typecodes = ('l','d')
+
+    def __init__(self, max_pairs, tmpdir=None):
+        self.max_pairs = max_pairs
+        self.dir = tempfile.mkdtemp(prefix='stackscore-runs-', dir=tmpdir)
+        self.runs = []
+        (self.key, self.value) = self.dtype.names
+        self.keys = array.array(self.typecodes[0])
+        self.values = array.array(self.typecodes[1])
+
+    def add(self, key, value):
+        self.keys.append(key)
+        self.values.append(value)
+        if (len(self.keys) >= self.max_pairs):
+            self.spill()
+
+    def add_array(self, keys, values):
+        """Add pairs from numpy arrays keys and values"""
+        self.keys.fromstring(keys.astype(self.dtype[self.key]).tostring())
+        self.values.fromstring(values.astype(self.dtype[self.value]).tostring())
+        if (len(self.keys) >= self.max_pairs):
+            self.spill()
+
+    def reduce(self, keys, values):
+        """Sum values per key, return sorted record array with one entry per key
+
+        The sort is stable so contributions for each key are summed in the order
+        they were added.
+        """
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        values = values[order]
+        run = numpy.zeros(0, dtype=self.dtype)
+        if (len(keys)):
+            starts = numpy.concatenate(([0], numpy.nonzero(keys[1:]!=keys[:-1])[0]+1))
+            run = numpy.zeros(len(starts), dtype=self.dtype)
+            run[self.key] = keys[starts]
+            run[self.value] = numpy.add.reduceat(values, starts)
+        return run
+
+    def spill(self):
+        """Write sorted and reduced buffered pairs as a new run"""
+        if (len(self.keys)==0):
+            return
+        run = self.reduce(numpy.frombuffer(self.keys, dtype=self.dtype[self.key]),
+                          numpy.frombuffer(self.values, dtype=self.dtype[self.value]))
+        file = os.path.join(self.dir, 'run%d' % (len(self.runs)))
+        run.tofile(file)
+        logging.info("Spilled run %s with %d %ss from %d pairs" % (file,len(run),self.key,len(self.keys)))
+        self.runs.append(file)
+        self.keys = array.array(self.typecodes[0])
+        self.values = array.array(self.typecodes[1])
+
+    def chunks(self, file, chunk_size, start=0, count=None):
+        """Read run file yielding record arrays of up to chunk_size entries
+
+        Reads count entries (default all) from entry start (default the beginning).
+        """
+        fh = open(file, 'rb')
+        fh.seek(start*self.dtype.itemsize)
+        while (count is None or count>0):
+            chunk = numpy.fromfile(fh, dtype=self.dtype, count=chunk_size if (count is None) else min(chunk_size, count))
+            if (len(chunk)==0):
+                break
+            if (count is not None):
+                count -= len(chunk)
+            yield chunk
+        fh.close()
+
+    def merge(self):
+        """Merge all runs into one run with a single value per key, return file name
+
+        Each step takes a chunk from every run and processes only entries up to the
+        smallest last key of those chunks, so all contributions for these keys are
+        present. Memory use is about max_pairs entries whatever the number of runs.
+        The number of keys in the merged run is set in num_keys.
+        """
+        self.spill()
+        file = os.path.join(self.dir, 'merged')
+        out = open(file, 'wb')
+        chunk_size = max(1024, self.max_pairs // (len(self.runs)+1))
+        readers = [self.chunks(run, chunk_size) for run in self.runs]
+        pending = [numpy.zeros(0, dtype=self.dtype) for run in self.runs]
+        self.num_keys = 0
+        while readers:
+            for j in range(len(readers)):
+                if (len(pending[j])==0 and readers[j] is not None):
+                    pending[j] = next(readers[j], numpy.zeros(0, dtype=self.dtype))
+                    if (len(pending[j])==0):
+                        readers[j] = None
+            active = [j for j in range(len(readers)) if readers[j] is not None]
+            if (not active):
+                break
+            upto = min([pending[j][self.key][-1] for j in active])
+            parts = []
+            for j in active:
+                n = numpy.searchsorted(pending[j][self.key], upto, side='right')
+                parts.append(pending[j][:n])
+                pending[j] = pending[j][n:]
+            part = numpy.concatenate(parts)
+            run = self.reduce(part[self.key], part[self.value])
+            run.tofile(out)
+            self.num_keys += len(run)
+        out.close()
+        for run in self.runs:
+            os.remove(run)
+        logging.info("Merged %d runs into %d %ss" % (len(self.runs),self.num_keys,self.key))
+        self.runs = [file]
+        return file
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class ScoreCountRuns(ScoreRuns):
+    """
+    Class to count items with each distinct raw score out of core
+
+    As ScoreRuns but summing (negated raw score, number of items) pairs, so that
+    the merged run is in order of descending raw score as needed to match to the
+    reference distribution (see match_reference_runs()).
+    """
+    dtype = numpy.dtype([('neg_score','<f8'),('count','<i8')])
+    typecodes = ('d','l')
+
+
+def compute_raw_scores_out_of_core(opt):
+    """Read in usage data and compute raw scores out of core, return merged ScoreRuns
+
+    As compute_raw_scores() but the per-bib_id sums are done through sorted runs on
+    disk with a buffer of about opt.memory_limit MB, in a temporary directory under
+    opt.tmpdir. The caller must call cleanup() on the result.
+    """
+    runs = ScoreRuns(max(1024, opt.memory_limit*1024*1024 // 64), opt.tmpdir)
+    try:
+        for (bib_id, score) in raw_score_contributions(opt):
+            runs.add(bib_id, score)
+        merged = runs.merge()
+        # raw scores distribution needs range first so takes two passes
+        (low, high) = (None, None)
+        for chunk in runs.chunks(merged, runs.max_pairs):
+            low = chunk['score'].min() if low is None else min(low, chunk['score'].min())
+            high = chunk['score'].max() if high is None else max(high, chunk['score'].max())
+        hist = numpy.zeros(100, dtype=numpy.int64)
+        bin_edges = numpy.histogram([], bins=100, range=(0.0, 1.0) if (low is None) else (low, high))[1]
+        for chunk in runs.chunks(merged, runs.max_pairs):
+            hist += numpy.histogram(chunk['score'], bins=bin_edges)[0]
+        write_float_hist(hist, bin_edges, runs.num_keys, opt.raw_scores_dist)
+    except:
+        runs.cleanup()
+        raise
+    return(runs)
+
+
+def match_reference_dist(counts, dist, total_items):
+    """Match raw scores to StackScores following the reference distribution dist
+
+    counts is a dict with the number of items for each raw score (which may be a
+    float). We do this starting from StackScore 100 and adding extra raw scores in
+    to meet the cumulative total most closely, using the cumulative target counts
+    for total_items from dist (see stackscore_reference.match_cumulative()). Returns
+    a dict of StackScore by raw score and a dict of number of items by StackScore.
+    """
+    scores = sorted(counts.keys(), reverse=True)
+    n = numpy.array([counts[score] for score in scores], dtype=numpy.int64)
+    ss = stackscore_reference.match_cumulative(n, reference_targets(dist, total_items))
+    stackscore_by_score = dict(zip(scores, ss.tolist()))
+    per_stackscore = numpy.bincount(ss, weights=n, minlength=101).astype(numpy.int64)
+    stackscore_counts = dict([(j, int(per_stackscore[j])) for j in numpy.unique(ss).tolist()])
+    check_lowest_stackscore(ss[-1] if len(ss) else None)
+    return(stackscore_by_score, stackscore_counts)
+
+
+def reference_targets(dist, total_items):
+    """Cumulative target counts from dist for total_items, cached if dist is a ReferenceDist"""
+    if (hasattr(dist, 'targets')):
+        return dist.targets(total_items)
+    return stackscore_reference.cumulative_targets(dist, total_items)
+
+
+def check_lowest_stackscore(ss):
+    """Warn if StackScore ss for the lowest raw score isn't 1 or 2 as expected"""
+    if (ss is not None and ss!=1 and ss!=2):
+        logging.warning("Distribution seems odd: expected to have ss==1 or ss==2 after normalizing, got ss=%d" % (ss))
+
+
+def match_reference_runs(runs, dist, total_items):
+    """Match raw scores counted in merged ScoreCountRuns runs to the reference distribution
+
+    Does the same as match_reference_dist() but reads the counts for each distinct
+    raw score in chunks, in order of descending raw score, so memory use doesn't
+    grow with the number of distinct raw scores. Returns (cut_scores,
+    cut_stackscores, stackscore_counts) where cut_scores is an ascending array of
+    the lowest raw score given each StackScore, cut_stackscores the corresponding
+    StackScores, and stackscore_counts a dict of number of items by StackScore.
+    """
+    matcher = stackscore_reference.CumulativeMatcher(reference_targets(dist, total_items))
+    per_stackscore = numpy.zeros(101, dtype=numpy.int64)
+    lowest = {}
+    ss = numpy.zeros(0, dtype=numpy.int64)
+    for chunk in runs.chunks(runs.runs[0], runs.max_pairs):
+        ss = matcher.match(chunk['count'])
+        per_stackscore += numpy.bincount(ss, weights=chunk['count'], minlength=101).astype(numpy.int64)
+        # StackScores don't increase with descending raw score, keep last of each
+        last = numpy.append(ss[1:]!=ss[:-1], True)
+        lowest.update(zip(ss[last].tolist(), (-chunk['neg_score'][last]).tolist()))
+    check_lowest_stackscore(ss[-1] if len(ss) else None)
+    cuts = sorted([(score, stackscore) for (stackscore, score) in lowest.items()])
+    cut_scores = numpy.array([c[0] for c in cuts], dtype=numpy.float64)
+    cut_stackscores = numpy.array([c[1] for c in cuts], dtype=numpy.int64)
+    stackscore_counts = dict([(j, int(per_stackscore[j])) for j in numpy.flatnonzero(per_stackscore).tolist()])
+    return(cut_scores, cut_stackscores, stackscore_counts)
+
+
+class ScoreSketch(object):
+    """
+    Mergeable sketch of the distribution of raw scores in a bounded number of buckets
+
+    Positive scores are counted in logarithmic buckets so that every score in
+    bucket key lies in (gamma^(key-1), gamma^key] and is within relative accuracy
+    of the bucket's representative value (as for DDSketch). Scores <=0 are counted
+    separately. If there are more than max_buckets buckets then the lowest buckets
+    are collapsed together, this loses resolution only at the low end of the
+    distribution which is all mapped to StackScore 1 anyway. Sketches with the same
+    accuracy of different parts of the raw scores may be merged, as is done for
+    the parts of the merged run sketched by worker processes in sketch_runs().
+    """
+
+    def __init__(self, accuracy=0.01, max_buckets=2048):
+        self.accuracy = accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1.0+accuracy)/(1.0-accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero = 0
+
+    @property
+    def count(self):
+        return self.zero + sum(self.buckets.values())
+
+    def key(self, score):
+        """Bucket key for score, None for scores <=0"""
+        if (score<=0):
+            return None
+        return int(math.ceil(math.log(score)/self.log_gamma))
+
+    def value(self, key):
+        """Representative value for bucket key, 0.0 for key None"""
+        if (key is None):
+            return 0.0
+        return 2.0*math.pow(self.gamma,key)/(self.gamma+1.0)
+
+    def add_array(self, scores):
+        """Add all raw scores in numpy array scores"""
+        positive = scores[scores>0]
+        self.zero += len(scores) - len(positive)
+        keys = numpy.ceil(numpy.log(positive)/self.log_gamma).astype(numpy.int64)
+        (keys, counts) = numpy.unique(keys, return_counts=True)
+        for (key, n) in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key,0) + n
+        if (len(self.buckets)>self.max_buckets):
+            self.collapse()
+
+    def merge(self, other):
+        """Merge counts from other sketch into this one"""
+        if (other.accuracy != self.accuracy):
+            raise Exception("Cannot merge sketches with different accuracy (%f and %f)" % (self.accuracy,other.accuracy))
+        self.zero += other.zero
+        for key in other.buckets:
+            self.buckets[key] = self.buckets.get(key,0) + other.buckets[key]
+        if (len(self.buckets)>self.max_buckets):
+            self.collapse()
+
+    def collapse(self):
+        """Collapse lowest buckets so that there are at most max_buckets"""
+        keys = sorted(self.buckets.keys())
+        lowest = keys[-self.max_buckets]
+        for key in keys[:-self.max_buckets]:
+            self.buckets[lowest] += self.buckets.pop(key)
+
+    def stackscore_cuts(self, dist, total_items):
+        """Match sketch to reference distribution and return cut points
+
+        Returns (cuts, stackscore_counts) where cuts is a list of (key, stackscore)
+        tuples sorted by key, giving the lowest bucket key for each StackScore, and
+        stackscore_counts is a dict of number of items by StackScore.
+        """
+        counts = {}
+        keys_by_value = {}
+        for key in self.buckets.keys() + ([None] if self.zero else []):
+            value = self.value(key)
+            counts[value] = self.zero if (key is None) else self.buckets[key]
+            keys_by_value[value] = key
+        (stackscore_by_value, stackscore_counts) = match_reference_dist(counts, dist, total_items)
+        lowest = {}
+        for value in stackscore_by_value:
+            ss = stackscore_by_value[value]
+            if (ss not in lowest or value<lowest[ss]):
+                lowest[ss] = value
+        cuts = sorted([(keys_by_value[lowest[ss]],ss) for ss in lowest])
+        return(cuts, stackscore_counts)
+
+
+def sketch_stackscore(score, cut_keys, cut_stackscores, sketch):
+    """StackScore for raw score given cut points from ScoreSketch.stackscore_cuts()
+
+    cut_keys and cut_stackscores are the key and StackScore lists from the cuts.
+    Scores below the lowest cut (only possible for collapsed or zero scores) get the
+    lowest StackScore.
+    """
+    key = sketch.key(score)
+    if (key is None):
+        return cut_stackscores[0]
+    return cut_stackscores[max(0, bisect.bisect_right(cut_keys, key)-1)]
+
+
+def sketch_run_part(args):
+    """Sketch raw scores in part of the merged run of a ScoreRuns, return ScoreSketch
+
+    Runs in a worker process. args is a tuple (runs, start, count, accuracy) to
+    sketch count entries from entry start, reading up to runs.max_pairs at a time.
+    """
+    (runs, start, count, accuracy) = args
+    sketch = ScoreSketch(accuracy)
+    for chunk in runs.chunks(runs.runs[0], runs.max_pairs, start, count):
+        sketch.add_array(chunk['score'])
+    return sketch
+
+
+def sketch_runs(runs, accuracy, processes=1):
+    """Sketch raw scores in merged ScoreRuns runs, return ScoreSketch
+
+    The merged run is split into parts of at most runs.max_pairs entries which are
+    sketched separately, in a pool of processes worker processes if processes>1,
+    and then merged. Memory use is about processes*runs.max_pairs entries plus
+    the sketches.
+    """
+    num_parts = max(processes, -(-runs.num_keys // runs.max_pairs))
+    part_size = max(1, -(-runs.num_keys // num_parts))
+    parts = [(runs, start, part_size, accuracy) for start in range(0, runs.num_keys, part_size)]
+    if (processes>1):
+        logging.info("Sketching %d parts of raw scores with %d processes" % (len(parts),processes))
+        pool = multiprocessing.Pool(processes)
+        try:
+            sketches = pool.map(sketch_run_part, parts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        sketches = [sketch_run_part(part) for part in parts]
+    sketch = ScoreSketch(accuracy)
+    for part_sketch in sketches:
+        sketch.merge(part_sketch)
+    return sketch
+
+
+def report_sketch_deviation(stackscore_counts, exact_counts, total_items, comments):
+    """Log and add to comments maximum deviation of sketch StackScore counts from exact counts"""
+    (deviation, at_ss) = max([(abs(stackscore_counts.get(ss,0)-exact_counts.get(ss,0)),ss) for ss in range(1,101)])
+    logging.warning("Sketch normalization maximum deviation from exact method is %d records (%.7f) at StackScore %d" % (deviation,float(deviation)/total_items,at_ss))
+    comments.append("maximum deviation from exact method = %d records (%.7f) at StackScore %d" % (deviation,float(deviation)/total_items,at_ss))
+
+
+def write_stackscore_comp(stackscore_counts, dist, total_items, file, comments=()):
+    """Write table comparing StackScore distribution with reference distribution"""
+    fh = open(file,'w')
+    fh.write("# Comparison of StackScore distribution with reference distribution\n#\n")
+    for comment in comments:
+        fh.write("# %s\n" % (comment))
+    if (comments):
+        fh.write("#\n")
+    fh.write("#score\trecords\tfraction\treference_fraction\n")
+    for ss in range(1,101):
+        fh.write("%d\t%d\t%.7f\t%.7f\n" % (ss,stackscore_counts.get(ss,0),float(stackscore_counts.get(ss,0))/total_items,dist.get(ss,0)))
+    fh.close()
+
+
+def stackscore_totals(num_scores, opt):
+    """Return (total_items, extra_items_with_score_one) given num_scores items with scores"""
+    if (opt.total_bib_ids):
+        total_items = opt.total_bib_ids
+        if (num_scores>total_items):
+            raise Exception("Sanity check failed: more scores (%d) than total_bib_ids (%d)!" % (num_scores,total_items))
+        return(total_items, total_items-num_scores)
+    return(num_scores, 0)
 
 
 def compute_stackscore(scores, dist, opt):
@@ -420,61 +1357,264 @@ def compute_stackscore(scores, dist, opt):
     We do not expect the the scores data to include all bib_ids, the total number of items
     is taken from the input parameter opt.total_bib_ids if specified (!=0) and thus there 
     will be at least (opt.total_bib_ids - len(scores)) items that will get score 1.
+
+    With opt.normalizer 'exact' (default) all distinct raw scores are matched to the
+    reference distribution. With 'sketch' the raw scores are summarized in a ScoreSketch
+    with relative accuracy opt.sketch_accuracy and StackScores are assigned from the cut
+    points derived from that. If opt.sketch_check is set then the maximum deviation
+    of the sketch distribution from the exact method is reported. Both keep all raw
+    scores in memory here, see compute_stackscore_out_of_core() for bounded memory.
     """
-    if (opt.total_bib_ids):
-        total_items = opt.total_bib_ids
-        if (len(scores)>total_items):
-            raise Exception("Sanity check failed: more scores (%d) than total_bib_ids (%d)!" % (len(scores),total_bib_ids))
-        extra_items_with_score_one = (total_items-len(scores))
+    (total_items, extra_items_with_score_one) = stackscore_totals(len(scores), opt)
+    comments = []
+    if (opt.normalizer == 'sketch'):
+        sketch = ScoreSketch(opt.sketch_accuracy)
+        sketch.add_array(numpy.fromiter(scores.itervalues(), dtype=numpy.float64, count=len(scores)))
+        logging.info("Have %d sketch buckets from %d items" % (len(sketch.buckets),len(scores)))
+        (cuts, stackscore_counts) = sketch.stackscore_cuts(dist, total_items)
+        cut_keys = [c[0] for c in cuts]
+        cut_stackscores = [c[1] for c in cuts]
+        stackscore={}
+        for bib_id in scores:
+            stackscore[bib_id]=sketch_stackscore(scores[bib_id], cut_keys, cut_stackscores, sketch)
+        comments.append("normalized with sketch, relative accuracy %g, %d buckets" % (opt.sketch_accuracy,len(sketch.buckets)))
+        if (opt.sketch_check):
+            counts = {}
+            for score in scores.itervalues():
+                counts[score] = counts.get(score,0) + 1
+            exact_counts = match_reference_dist(counts, dist, total_items)[1]
+            report_sketch_deviation(stackscore_counts, exact_counts, total_items, comments)
     else:
-        total_items = len(scores)
-        extra_items_with_score_one = 0
-    # Get counts of items for each raw score (which may be a float)
-    counts = {}
-    for bib_id in scores:
-        score = scores[bib_id]
-        counts[score] = counts.get(score,0) + 1
-    # Determine StackScore for each score by matching to the reference distribution in
-    # dist. We do this starting from StackScore 100 and adding extra raw scores in
-    # to meet the cumulative total most closely.
-    num_scores = len(counts)
-    logging.info("Have %d distinct raw scores from %d items" % (num_scores,len(scores)))
-    count = 0
-    stackscore_by_score = {}
-    stackscore_counts = {}
-    n = 0
-    ss = 100
-    ss_frac = dist[ss] # cumulative fraction we want to get to for this StackScore
-    for score in reversed(sorted(counts.keys())):
-        # do we add to this StackScore or the next lower?
-        n = counts[score]
-        ss_count = int(ss_frac*total_items) # integer cumulative count
-        if ((count+n > ss_count) and ((count+n)-ss_count) > (ss_count-count) and ss>1):
-            # should add to next lower StackScore
-            ss -= 1
-            ss_frac += dist[ss]
-        count += n
-        stackscore_by_score[score] = ss
-        stackscore_counts[ss] = stackscore_counts.get(ss,0) + n
+        # Get counts of items for each raw score (which may be a float)
+        counts = {}
+        for bib_id in scores:
+            score = scores[bib_id]
+            counts[score] = counts.get(score,0) + 1
+        # Determine StackScore for each score by matching to the reference distribution in
+        # dist.
+        num_scores = len(counts)
+        logging.info("Have %d distinct raw scores from %d items" % (num_scores,len(scores)))
+        (stackscore_by_score, stackscore_counts) = match_reference_dist(counts, dist, total_items)
+        # now we have lookup table of score->StackScore, make set of StackScores
+        stackscore={}
+        for bib_id in scores:
+            stackscore[bib_id]=stackscore_by_score[scores[bib_id]]
     # add in extra counts for score 1
-    if (ss!=1 and ss!=2):
-        logging.warning("Distribution seems odd: expected to have ss==1 or ss==2 after normalizing, got ss=%d" % (ss))
     stackscore_counts[1] = stackscore_counts.get(1,0) + extra_items_with_score_one
     # write table comparing with reference distribution
-    fh = open(opt.stackscore_comp,'w')
-    fh.write("# Comparison of StackScore distribution with reference distribution\n#\n")
-    fh.write("#score\trecords\tfraction\treference_fraction\n")
-    for ss in range(1,101):
-        fh.write("%d\t%d\t%.7f\t%.7f\n" % (ss,stackscore_counts.get(ss,0),float(stackscore_counts.get(ss,0))/total_items,dist.get(ss,0)))
-    fh.close()
-    # now we have lookup table of score->StackScore, make set of StackScores, dump
-    # them and write out the distribution
-    stackscore={}
-    for bib_id in scores:
-        stackscore[bib_id]=stackscore_by_score[scores[bib_id]]
+    write_stackscore_comp(stackscore_counts, dist, total_items, opt.stackscore_comp, comments)
+    # dump StackScores and write out the distribution
     if (opt.stackscores):
         write_stackscores(stackscore, opt.stackscores)
     write_dist(stackscore, opt.stackscore_dist, extra_score_one=extra_items_with_score_one)
+    return(stackscore_counts, total_items)
+
+
+def exact_cuts_out_of_core(runs, dist, total_items, opt):
+    """Match raw scores in merged ScoreRuns runs exactly to the reference distribution
+
+    The number of items with each distinct raw score is counted through a second
+    set of sorted runs on disk (see ScoreCountRuns) and matched to get cut points.
+    Returns (cut_scores, cut_stackscores, stackscore_counts) as from
+    match_reference_runs().
+    """
+    counts = ScoreCountRuns(runs.max_pairs, opt.tmpdir)
+    try:
+        for chunk in runs.chunks(runs.runs[0], runs.max_pairs):
+            (neg_scores, n) = numpy.unique(-chunk['score'], return_counts=True)
+            counts.add_array(neg_scores, n)
+        counts.merge()
+        logging.info("Have %d distinct raw scores from %d items" % (counts.num_keys,runs.num_keys))
+        return match_reference_runs(counts, dist, total_items)
+    finally:
+        counts.cleanup()
+
+
+def compute_stackscore_out_of_core(runs, dist, opt):
+    """Compute StackScores from raw scores in merged ScoreRuns runs
+
+    Does the same as compute_stackscore() but reads the raw scores in chunks
+    from the merged run, once to match the distribution to the reference
+    distribution and again to assign and write StackScores in bib_id order. With
+    opt.normalizer 'exact' the cut points come from exact_cuts_out_of_core(), with
+    'sketch' the raw scores are summarized by sketch_runs() in opt.sketch_processes
+    worker processes and opt.sketch_check compares with exact_cuts_out_of_core().
+    Either way memory use is bounded by opt.memory_limit (per sketch process)
+    rather than growing with the number of items or distinct raw scores.
+    """
+    merged = runs.runs[0]
+    (total_items, extra_items_with_score_one) = stackscore_totals(runs.num_keys, opt)
+    comments = []
+    if (opt.normalizer == 'sketch'):
+        sketch = sketch_runs(runs, opt.sketch_accuracy, opt.sketch_processes)
+        logging.info("Have %d sketch buckets from %d items" % (len(sketch.buckets),runs.num_keys))
+        (cuts, stackscore_counts) = sketch.stackscore_cuts(dist, total_items)
+        cut_keys = numpy.array([c[0] for c in cuts], dtype=numpy.int64)
+        cut_stackscores = numpy.array([c[1] for c in cuts], dtype=numpy.int64)
+        def stackscores_of(scores):
+            keys = numpy.ceil(numpy.log(numpy.maximum(scores, 1e-300))/sketch.log_gamma).astype(numpy.int64)
+            ss = cut_stackscores[numpy.maximum(0, numpy.searchsorted(cut_keys, keys, side='right')-1)]
+            ss[scores<=0] = cut_stackscores[0]
+            return ss
+        comments.append("normalized with sketch, relative accuracy %g, %d buckets" % (opt.sketch_accuracy,len(sketch.buckets)))
+        if (opt.sketch_check):
+            exact_counts = exact_cuts_out_of_core(runs, dist, total_items, opt)[2]
+            report_sketch_deviation(stackscore_counts, exact_counts, total_items, comments)
+    else:
+        (cut_scores, cut_stackscores, stackscore_counts) = exact_cuts_out_of_core(runs, dist, total_items, opt)
+        def stackscores_of(scores):
+            # every raw score is at least the lowest cut, take StackScore of highest cut below
+            return cut_stackscores[numpy.searchsorted(cut_scores, scores, side='right')-1]
+    stackscore_counts[1] = stackscore_counts.get(1,0) + extra_items_with_score_one
+    write_stackscore_comp(stackscore_counts, dist, total_items, opt.stackscore_comp, comments)
+    # assign StackScores a chunk at a time, collecting distribution as we go
+    example_bib_id = {}
+    def assigned():
+        for chunk in runs.chunks(merged, runs.max_pairs):
+            ss = stackscores_of(chunk['score'])
+            (values, first) = numpy.unique(ss, return_index=True)
+            for (value, j) in zip(values.tolist(), first.tolist()):
+                if (value not in example_bib_id):
+                    example_bib_id[value] = int(chunk['bib_id'][j]) if (opt.examples) else '-'
+            for pair in zip(chunk['bib_id'].tolist(), ss.tolist()):
+                yield pair
+    if (opt.stackscores):
+        write_stackscores(assigned(), opt.stackscores, runs.num_keys)
+    else:
+        for pair in assigned():
+            pass
+    num_bib_ids = dict(stackscore_counts)
+    num_bib_ids[1] -= extra_items_with_score_one
+    if (num_bib_ids[1]==0):
+        del num_bib_ids[1]
+    total_counts = sum([ss*n for (ss, n) in num_bib_ids.items()])
+    write_dist_counts(num_bib_ids, example_bib_id, total_counts, opt.stackscore_dist, extra_score_one=extra_items_with_score_one)
+    return(stackscore_counts, total_items)
+
+
+def score_stackscores(dist, opt):
+    """Compute raw scores and then StackScores, in memory or out of core according to opt"""
+    if (opt.out_of_core):
+        runs = compute_raw_scores_out_of_core(opt)
+        try:
+            return compute_stackscore_out_of_core(runs, dist, opt)
+        finally:
+            runs.cleanup()
+    scores = compute_raw_scores(opt)
+    return compute_stackscore(scores, dist, opt)
+
+
+def read_batch_manifest(file):
+    """Read manifest of institution inputs for batch scoring
+
+    File format has # for comment lines, then one institution per line with
+    name, charge and browse file, circulation transactions file and optionally
+    the total number of bib_ids in that institution's catalog:
+
+    #name     charge_and_browse              circ_trans              total_bib_ids
+    cornell   cornell-charge-and-browse.gz   cornell-circ-trans.gz   7000000
+    other     other-charge-and-browse.gz     other-circ-trans.gz
+    """
+    logging.info("Reading batch manifest from %s..." % (file))
+    fh = open(file,'r')
+    institutions = []
+    names = set()
+    for line in fh:
+        if (re.match(r'^\s*(#|$)',line)):
+            continue
+        fields = line.split()
+        if (len(fields) not in (3,4)):
+            raise Exception("Bad line in batch manifest %s: '%s'" % (file,line.strip()))
+        inst = { 'name': fields[0],
+                 'charge_and_browse': fields[1],
+                 'circ_trans': fields[2],
+                 'total_bib_ids': int(fields[3]) if (len(fields)==4) else 0 }
+        if (inst['name'] in names):
+            raise Exception("Duplicate institution name '%s' in batch manifest %s" % (inst['name'],file))
+        names.add(inst['name'])
+        institutions.append(inst)
+    fh.close()
+    return institutions
+
+
+def institution_file(name, file):
+    """Name of per-institution output file, file with basename prefixed by name"""
+    (dirname, basename) = os.path.split(file)
+    return os.path.join(dirname, "%s_%s" % (name,basename))
+
+
+def score_institution(args):
+    """Compute raw scores and StackScores for one institution in a batch run
+
+    Runs in a worker process. args is a tuple (inst, dist, opt) where inst is
+    a dict from read_batch_manifest(), dist is the shared reference distribution
+    and opt are the global options which are copied and overridden with the
+    institution's inputs and output file names.
+    """
+    (inst, dist, opt) = args
+    name = inst['name']
+    inst_opt = copy.copy(opt)
+    inst_opt.charge_and_browse = inst['charge_and_browse']
+    inst_opt.circ_trans = inst['circ_trans']
+    inst_opt.total_bib_ids = inst['total_bib_ids']
+    inst_opt.raw_scores_dist = institution_file(name, opt.raw_scores_dist)
+    inst_opt.stackscore_dist = institution_file(name, opt.stackscore_dist)
+    inst_opt.stackscore_comp = institution_file(name, opt.stackscore_comp)
+    if (opt.stackscores):
+        inst_opt.stackscores = institution_file(name, opt.stackscores)
+    if (opt.item_report):
+        inst_opt.item_report = institution_file(name, opt.item_report)
+    logging.info("Scoring %s in process %d" % (name,os.getpid()))
+    (stackscore_counts, total_items) = score_stackscores(dist, inst_opt)
+    return(name, stackscore_counts, total_items)
+
+
+def batch_stackscores(opt):
+    """Compute StackScores for several institutions against a common reference
+
+    Institutions are read from the manifest opt.batch_manifest and scored
+    concurrently in a pool of opt.batch_processes worker processes. The reference
+    distribution is read once and shared with all workers. Each institution gets
+    its own set of output files (see institution_file()) and a merged table
+    comparing the StackScore distributions of all institutions with the reference
+    distribution is written to opt.batch_comp.
+    """
+    institutions = read_batch_manifest(opt.batch_manifest)
+    if (len(institutions)==0):
+        raise Exception("No institutions in batch manifest %s" % (opt.batch_manifest))
+    if (opt.screen or opt.screen_only):
+        passed = True
+        for inst in institutions:
+            passed &= screen_inputs(inst['charge_and_browse'], inst['circ_trans'],
+                                    institution_file(inst['name'], opt.screen_report), opt)
+        if (not passed or opt.screen_only):
+            return(passed)
+    dist = stackscore_reference.read_reference_dist(opt.reference_dist, opt.reference_cache)
+    for inst in institutions:
+        if (inst['total_bib_ids']):
+            dist.targets(inst['total_bib_ids'])
+    processes = min(opt.batch_processes or multiprocessing.cpu_count(), len(institutions))
+    logging.info("Scoring %d institutions with %d processes" % (len(institutions),processes))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(score_institution, [(inst, dist, opt) for inst in institutions])
+    finally:
+        pool.close()
+        pool.join()
+    # write merged comparison table, results are in manifest order
+    logging.info("Writing batch comparison to %s..." % (opt.batch_comp))
+    fh = open(opt.batch_comp,'w')
+    fh.write("# Comparison of StackScore distributions with reference distribution\n#\n")
+    for (name, stackscore_counts, total_items) in results:
+        fh.write("# %s: total bib_ids = %d\n" % (name,total_items))
+    fh.write("#\n#score\treference_fraction\t%s\n" % ('\t'.join([r[0] for r in results])))
+    for ss in range(1,101):
+        fh.write("%d\t%.7f" % (ss,dist.get(ss,0)))
+        for (name, stackscore_counts, total_items) in results:
+            fh.write("\t%.7f" % (float(stackscore_counts.get(ss,0))/total_items))
+        fh.write("\n")
+    fh.close()
+    return(True)
 
 ##################################################################
 
@@ -482,21 +1622,60 @@ def compute_stackscore(scores, dist, opt):
 p = optparse.OptionParser(description='Parser for CUL usage data',
                           usage='usage: %prog [[opts]] [file1] .. [fileN]')
 p.add_option('--charge-and-browse', action='store', default='testdata/subset-charge-and-browse-counts.tsv.gz',
-             help="Charge and browse num_bib_ids, gzipped input file (default %default)")
+             help="Charge and browse num_bib_ids, compressed input file (default %default)")
 p.add_option('--circ-trans', action='store', default='testdata/subset-circ-trans.tsv.gz',
-             help="Circulation transactions, gzipped input file (default %default)")
+             help="Circulation transactions, compressed input file (default %default)")
 p.add_option('--total-bib-ids', action='store', type='int', default=0,
              help="Total number of bib_ids in the catalog (omit to use only input data)")
+p.add_option('--reference-date', action='store',
+             help="Date YYYY-MM-DD to compute circulation ages relative to, later "
+                  "circulation transactions are ignored (default today)")
+p.add_option('--circ-halflife', action='store', type='float', default=5.0,
+             help="Number of years back that a circulation transaction has half weight (default %default)")
+p.add_option('--circ-window', action='store', type='float', default=0.0,
+             help="Include only circulation transactions within this number of years "
+                  "before the reference date (default 0 for all)")
+p.add_option('--circ-rollup', action='store',
+             help="Take circulation data from rollup file written with --make-circ-rollup "
+                  "instead of reading --circ-trans, with --reference-date only periods "
+                  "ending on or before that date are used")
 p.add_option('--reference-dist', action='store', default='reference_dist.dat',
              help="Reference distribution over the range 1..100 to match to (default %default)")
+p.add_option('--reference-cache', action='store',
+             help="Directory to cache cumulative reference targets for each total number of items "
+                  "(default no cache)")
+p.add_option('--normalizer', action='store', type='choice', choices=['exact','sketch'], default='exact',
+             help="Normalization to reference distribution, exact or approximate using a "
+                  "sketch of raw scores, memory is bounded only with --out-of-core (default %default)")
+p.add_option('--sketch-accuracy', action='store', type='float', default=0.01,
+             help="Relative accuracy of raw scores in sketch normalizer (default %default)")
+p.add_option('--sketch-check', action='store_true',
+             help="Report maximum deviation of sketch normalizer from exact method")
+p.add_option('--sketch-processes', action='store', type='int', default=1,
+             help="Number of worker processes sketching parts of the raw scores with "
+                  "--normalizer sketch --out-of-core, sketches are merged (default %default)")
+p.add_option('--out-of-core', action='store_true',
+             help="Sum raw scores through sorted runs on disk for data that doesn't fit in memory")
+p.add_option('--memory-limit', action='store', type='int', default=512,
+             help="Approximate memory in MB for buffering raw score contributions and counts out of core (default %default)")
+p.add_option('--tmpdir', action='store',
+             help="Directory for temporary out of core run files (default system temporary directory)")
 p.add_option('--raw-scores-dist', action='store', default='raw_scores_dist.dat',
              help="Distribution of raw scores (default %default)")
 p.add_option('--stackscores', action='store',
-             help="StackScores output file (not written by default, will be gzipped)")
+             help="StackScores output file (not written by default, will be compressed)")
 p.add_option('--stackscore_dist', action='store', default='stackscore_dist.dat',
              help="StackScore distribution output file (default %default)")
 p.add_option('--stackscore_comp', action='store', default='stackscore_dist_comp.dat',
              help="StackScore distribution comparison with reference (default %default)")
+p.add_option('--compression', action='store', type='choice', choices=compressed_io.CODECS,
+             help="Codec for compressed outputs, one of %s (default from "
+                  "file extension, else gzip)" % (', '.join(compressed_io.CODECS)))
+p.add_option('--compression-level', action='store', type='int',
+             help="Compression level for compressed outputs (default depends on codec, 9 for gzip)")
+p.add_option('--compression-threads', action='store', type='int', default=0,
+             help="Threads for pigz and zstd compression (default %default for pigz one per "
+                  "CPU, for zstd single-threaded)")
 p.add_option('--logfile', action='store',
              help="Send log output to specified file")
 p.add_option('--examples', action='store_true',
@@ -507,6 +1686,37 @@ p.add_option('--verbose', '-v', action='store_true',
 p.add_option('--analyze', action='store_true',
              help="Do analysis of input distributions")
 
+p.add_option('--batch-manifest', action='store',
+             help="Score all institutions listed in manifest file against the reference "
+                  "distribution, per-institution outputs are prefixed with the institution name")
+p.add_option('--batch-processes', action='store', type='int', default=0,
+             help="Number of worker processes for batch scoring (default one per CPU)")
+p.add_option('--batch-comp', action='store', default='stackscore_dist_batch_comp.dat',
+             help="Merged StackScore distribution comparison for batch scoring (default %default)")
+
+p.add_option('--screen', action='store_true',
+             help="Screen input data for bad data first and stop if screening fails")
+p.add_option('--screen-only', action='store_true',
+             help="Screen input data for bad data and stop")
+p.add_option('--screen-report', action='store', default='screen_report.dat',
+             help="Screening report output file (default %default)")
+p.add_option('--screen-max-rate', action='store', type='float', default=0.001,
+             help="Maximum rate of any screening problem before failing (default %default)")
+p.add_option('--screen-z', action='store', type='float', default=10.0,
+             help="Robust z-score above which per bib_id counts are outliers (default %default)")
+p.add_option('--screen-earliest', action='store', default='1990-01-01',
+             help="Earliest expected circulation transaction date (default %default)")
+
+p.add_option('--item-report', action='store',
+             help="Also write per-item usage and multi-item bib_id report to named file "
+                  "when scoring, needs --circ-trans rather than --circ-rollup, "
+                  "item_ids must be below 2^31 and bib_ids below 2^32")
+
+p.add_option('--make-circ-rollup', action='store',
+             help="Aggregate circulation transactions by bib_id and period, write to named .npz file")
+p.add_option('--rollup-period', action='store', type='choice', choices=['month','year'], default='month',
+             help="Period for circulation rollup, month or year (default %default)")
+
 p.add_option('--make-randomized-subset', action='store_true',
              help="Make a smaller subset of the input data and write out again")
 p.add_option('--subset-fraction', action='store', type='float', default=0.01,
@@ -517,6 +1727,15 @@ p.add_option('--subset-circ-trans', action='store', default='subset-circ-trans.t
              help="Name of output file for subset circulation transactions (default %default)")
 
 (opt, args) = p.parse_args()
+if (opt.reference_date):
+    opt.reference_date = datetime.datetime.strptime(opt.reference_date, "%Y-%m-%d").date()
+opt.screen_earliest = datetime.datetime.strptime(opt.screen_earliest, "%Y-%m-%d").date()
+if (opt.item_report and opt.circ_rollup):
+    p.error("--item-report needs per-item circulation transactions, not --circ-rollup")
+if (opt.sketch_processes<1):
+    p.error("--sketch-processes must be at least 1")
+if (opt.sketch_processes>1 and opt.batch_manifest):
+    p.error("--sketch-processes can't be used with --batch-manifest, institutions are already scored in worker processes")
 
 level = logging.INFO if opt.verbose else logging.WARN
 if (opt.logfile):
@@ -525,14 +1744,25 @@ else:
     logging.basicConfig(level=level)
 
 logging.info("STARTED at %s" % (datetime.datetime.now()))
-if (opt.make_randomized_subset):
+if (opt.compression):
+    opt.compression = compressed_io.available_codec(opt.compression)
+if ((opt.screen or opt.screen_only) and not opt.batch_manifest):
+    if (not screen_inputs(opt.charge_and_browse, opt.circ_trans, opt.screen_report, opt)):
+        sys.exit(1)
+if (opt.screen_only and not opt.batch_manifest):
+    pass
+elif (opt.make_randomized_subset):
     make_randomized_subset(opt)
+elif (opt.make_circ_rollup):
+    make_circ_rollup(opt)
 elif (opt.analyze):
     analyze_distributions(opt)
+elif (opt.batch_manifest):
+    if (not batch_stackscores(opt)):
+        sys.exit(1)
 else:
-    scores = compute_raw_scores(opt)
-    dist = read_reference_dist(opt.reference_dist)
-    compute_stackscore(scores, dist, opt)
+    dist = stackscore_reference.read_reference_dist(opt.reference_dist, opt.reference_cache)
+    score_stackscores(dist, opt)
 logging.info("FINISHED at %s" % (datetime.datetime.now()))
 
 
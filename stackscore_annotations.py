@@ -6,18 +6,26 @@ Timing:
   10s to read 2.3M stackscores into dict
   150min to parse 2M records from Cornell LD4L RDF and write annotations
   => expect 600min = 10h to write annotations for 8M records
+
+Because of the run time, completed input files are recorded in a checkpoint
+manifest so that an interrupted run can be restarted, and the input files may
+be split into shards (--shard i/N) run separately and then checked with --merge.
 """
 
 import glob
-import gzip
+import hashlib
+import json
 import logging
 import optparse
 import os.path
 from rdflib import Graph, URIRef, Literal
 from rdflib.namespace import Namespace, NamespaceManager, RDF
 import re
+import sys
 import time
 
+import compressed_io
+
 def split_multiext(filename, max=2):
     """Wrapper around os.path.splitext to remove potentially multiple extensions."""
     all_ext = ''
@@ -37,7 +45,7 @@ def read_stackscores(filename):
     Each line is simply bibid and stackscore
     """
     logging.info("Reading StackScores from %s..." % (filename))
-    fh = gzip.open(filename,'r')
+    fh = compressed_io.open_input(filename)
     scores = {}
     n = 0
     for line in fh:
@@ -127,11 +135,8 @@ class NTriplesStreamer(NTriplesParser):
         self.sink = StoreSink()
 
     def open(self, filename):
-        """Open that handles plain of gzipped files based on extension typing."""
-        if (filename.endswith('.gz')):
-            self.file = gzip.open(filename,'r')
-        else:
-            self.file = open(filename,'r')
+        """Open that handles plain or compressed files based on sniffing the content."""
+        self.file = compressed_io.open_input(filename)
         # since N-Triples 1.1 files can and should be utf-8 encoded
         self.file = codecs.getreader('utf-8')(self.file)
 
@@ -173,15 +178,20 @@ def process_file(bib_file, namespace_manager):
     ils_id? rdf:value literal_value? .
 
     For each input file, create an output file in the local directory but with a 
-    similar name to the input file that contains the annotations.
+    similar name to the input file that contains the annotations. Returns
+    (ss_anno_file, n) where n is the number of scores written, or None if
+    writing failed.
     """
     # Start new greph for this file
     g = Graph()
     g.namespace_manager = namespace_manager
     nts = NTriplesStreamer()
     # Work out output file name
-    ss_anno_file = split_multiext(os.path.basename(bib_file))[0] + "-ss-anno.nt.gz"
-    ss_anno_fh = gzip.open(ss_anno_file,'w')
+    ss_anno_file = split_multiext(os.path.basename(bib_file))[0] + "-ss-anno.nt" + \
+        compressed_io.EXTENSIONS[opts.compression]
+    # Write to temporary file renamed when complete so there are no partial outputs
+    ss_anno_tmp = ss_anno_file + '.tmp'
+    ss_anno_fh = compressed_io.open_output(ss_anno_tmp, opts.compression, opts.compression_level, opts.compression_threads)
     logging.info("Parsing %s, writing %s" % (bib_file,ss_anno_file))
     # Read the file pulling out four types of triple we need and
     # stashing the results in in-memory data structures:
@@ -239,10 +249,152 @@ def process_file(bib_file, namespace_manager):
     try:
         ss_anno_fh.write(g.serialize(format='nt'))
         ss_anno_fh.close()
+        os.rename(ss_anno_tmp, ss_anno_file)
         logging.info("-- wrote %d scores" % (n))
     except Exception as e: 
         logging.warn("Writing %s failed: %s", bib_file, str(e))
-    return(n)
+        if (os.path.exists(ss_anno_tmp)):
+            os.remove(ss_anno_tmp)
+        return(None)
+    return(ss_anno_file, n)
+
+def file_checksum(filename):
+    """SHA1 hex digest of the contents of filename."""
+    sha1 = hashlib.sha1()
+    fh = open(filename, 'rb')
+    while True:
+        data = fh.read(1024*1024)
+        if (not data):
+            break
+        sha1.update(data)
+    fh.close()
+    return sha1.hexdigest()
+
+def file_fingerprint(filename):
+    """Cheap fingerprint of filename based on its size and modification time."""
+    st = os.stat(filename)
+    return "%d-%d" % (st.st_size, int(st.st_mtime))
+
+def parse_shard(shard):
+    """Parse shard specification i/N, with 1<=i<=N, into (i,N)."""
+    m = re.match(r'^(\d+)/(\d+)$', shard)
+    if (not m or not (1 <= int(m.group(1)) <= int(m.group(2)))):
+        raise ValueError("Bad shard '%s', expected i/N with 1<=i<=N" % (shard))
+    return (int(m.group(1)), int(m.group(2)))
+
+def in_shard(bib_file, shard):
+    """True if bib_file is in shard (i,N), assigned by hash of the file basename.
+
+    Using the basename, which also determines the output file name, means that the
+    assignment is the same on all machines whatever the input directory.
+    """
+    (i, n) = shard
+    h = int(hashlib.md5(os.path.basename(bib_file)).hexdigest(), 16)
+    return (h % n) == (i - 1)
+
+def read_manifest(filename, must_exist=False):
+    """Read checkpoint manifest from filename, empty manifest if it doesn't exist.
+
+    If must_exist is set then a missing manifest is an error.
+    """
+    if (not os.path.exists(filename)):
+        if (must_exist):
+            raise Exception("Manifest %s does not exist" % (filename))
+        return {'files': {}}
+    fh = open(filename, 'r')
+    manifest = json.load(fh)
+    fh.close()
+    return manifest
+
+def write_manifest(manifest, filename):
+    """Write checkpoint manifest to filename via temporary file and rename."""
+    tmp = filename + '.tmp'
+    fh = open(tmp, 'w')
+    json.dump(manifest, fh, indent=1, sort_keys=True)
+    fh.close()
+    os.rename(tmp, filename)
+
+def entry_problem(entry, fingerprint=None, stackscores_sha1=None):
+    """Return description of problem with manifest entry, None if it is complete.
+
+    An entry is complete if the output exists with the recorded size and checksum
+    and, if given, the input fingerprint and StackScore table checksum are unchanged.
+    """
+    if (fingerprint is not None and entry.get('fingerprint') != fingerprint):
+        return "input changed"
+    if (stackscores_sha1 is not None and entry.get('stackscores_sha1') != stackscores_sha1):
+        return "StackScores changed"
+    if (not os.path.exists(entry['output'])):
+        return "output %s missing" % (entry['output'])
+    if (os.path.getsize(entry['output']) != entry['size'] or
+        file_checksum(entry['output']) != entry['sha1']):
+        return "output %s checksum mismatch" % (entry['output'])
+    return None
+
+def merge_manifests(filenames, merged_file):
+    """Merge and validate shard manifests, write merged manifest to merged_file.
+
+    Checks that the manifests are from shards i/N covering 1..N once each with
+    the same N (or are from unsharded runs), that all shards used the same
+    StackScore table, that no input or output file appears more than once, and
+    that every output is complete. The merged manifest is written only if all
+    is well, returns True in that case.
+    """
+    merged = {'files': {}, 'shards': []}
+    outputs = {}
+    shards = {}
+    ok = True
+    for filename in filenames:
+        manifest = read_manifest(filename, must_exist=True)
+        merged['shards'].append(filename)
+        shards[filename] = parse_shard(manifest['shard']) if ('shard' in manifest) else None
+        if ('stackscores_sha1' in merged and manifest.get('stackscores_sha1') != merged['stackscores_sha1']):
+            logging.error("Manifest %s used different StackScores %s" % (filename, manifest.get('stackscores')))
+            ok = False
+        merged.setdefault('stackscores', manifest.get('stackscores'))
+        merged.setdefault('stackscores_sha1', manifest.get('stackscores_sha1'))
+        for (bib_file, entry) in sorted(manifest['files'].items()):
+            if (bib_file in merged['files']):
+                logging.error("Input %s is in more than one manifest" % (bib_file))
+                ok = False
+            elif (entry['output'] in outputs):
+                logging.error("Output %s is from both %s and %s" % (entry['output'], outputs[entry['output']], bib_file))
+                ok = False
+            problem = entry_problem(entry, stackscores_sha1=merged['stackscores_sha1'])
+            if (problem):
+                logging.error("Input %s in %s incomplete: %s" % (bib_file, filename, problem))
+                ok = False
+            merged['files'][bib_file] = entry
+            outputs[entry['output']] = bib_file
+    sharded = [filename for filename in filenames if shards[filename]]
+    if (sharded):
+        if (len(sharded) < len(filenames)):
+            logging.error("Manifests %s are not from sharded runs" %
+                          (', '.join([f for f in filenames if not shards[f]])))
+            ok = False
+        num_shards = set([shards[f][1] for f in sharded])
+        if (len(num_shards) > 1):
+            logging.error("Manifests are from shards of different numbers %s" %
+                          (', '.join([str(n) for n in sorted(num_shards)])))
+            ok = False
+        for n in num_shards:
+            present = [shards[f][0] for f in sharded if shards[f][1]==n]
+            missing = [str(i) for i in range(1, n+1) if i not in present]
+            if (missing):
+                logging.error("Missing manifests for shards %s of %d" % (', '.join(missing), n))
+                ok = False
+            repeated = sorted(set([str(i) for i in present if present.count(i) > 1]))
+            if (repeated):
+                logging.error("More than one manifest for shards %s of %d" % (', '.join(repeated), n))
+                ok = False
+    if (not ok):
+        logging.error("Not writing merged manifest %s" % (merged_file))
+        return ok
+    write_manifest(merged, merged_file)
+    logging.info("Merged %d manifests with %d files and %d records into %s" %
+                 (len(filenames), len(merged['files']),
+                  sum([e['count'] for e in merged['files'].values()]), merged_file))
+    return ok
 
 p = optparse.OptionParser(description='Stackscore RDF generation for LD4L',
                           usage="%0 [[input-files.nt]]")
@@ -250,6 +402,20 @@ p.add_option('--stackscores', action='store', default='stackscores.dat.gz',
              help="Input file of stackscores, format is 'bibid stackscore', "
                   "one per line. Bibids without an entry will get an annotation "
                   "of stackscore 1.")
+p.add_option('--compression', action='store', type='choice', choices=compressed_io.CODECS,
+             help="Codec for annotation output files, one of %s (default gzip)" % (', '.join(compressed_io.CODECS)))
+p.add_option('--compression-level', action='store', type='int',
+             help="Compression level for annotation output files (default depends on codec, 9 for gzip)")
+p.add_option('--compression-threads', action='store', type='int', default=0,
+             help="Threads for pigz and zstd compression (default %default for pigz one per "
+                  "CPU, for zstd single-threaded)")
+p.add_option('--manifest', action='store',
+             help="Checkpoint manifest recording completed input files, default "
+                  "ss-anno-manifest.json or ss-anno-manifest-i-of-N.json with --shard")
+p.add_option('--shard', action='store',
+             help="Process only shard i/N of the input files (1<=i<=N)")
+p.add_option('--merge', action='store_true',
+             help="Merge and validate the shard manifests given as arguments into --manifest")
 p.add_option('--logfile', action='store', default=None,
              help="Write logging output to file instead of STDOUT")
 (opts, bib_files) = p.parse_args()
@@ -257,17 +423,65 @@ p.add_option('--logfile', action='store', default=None,
 extra = {'filename': opts.logfile } if opts.logfile else {}
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%dT%H:%M:%S', level=logging.INFO, **extra)
 
+try:
+    shard = parse_shard(opts.shard) if opts.shard else None
+except ValueError as e:
+    p.error(str(e))
+manifest_file = opts.manifest
+if (manifest_file is None):
+    manifest_file = ('ss-anno-manifest-%d-of-%d.json' % shard) if shard else 'ss-anno-manifest.json'
+
+if (opts.merge):
+    if (len(bib_files) == 0):
+        p.error("--merge needs the shard manifests to merge as arguments")
+    sys.exit(0 if merge_manifests(bib_files, manifest_file) else 1)
+
+# Resolve codec first so output file extensions match what is actually written
+opts.compression = compressed_io.available_codec(opts.compression or 'gzip')
 scores = read_stackscores(opts.stackscores)
+manifest = read_manifest(manifest_file)
+manifest['stackscores'] = opts.stackscores
+manifest['stackscores_sha1'] = file_checksum(opts.stackscores)
+if (shard):
+    manifest['shard'] = opts.shard
+write_manifest(manifest, manifest_file)
 
 # Iterate from bib_files treating each one separately because we know
 # that they conatin complete LD4L models for a number of MARC records.
+# Files recorded as complete in the manifest are skipped so that an
+# interrupted run can be restarted.
 # 
 start_time = time.time()
 records = 0
+failed = []
 for bib_glob in bib_files:
-    for bib_file in glob.glob(bib_glob):
-        records += process_file(bib_file, namespace_manager)
+    for bib_file in sorted(glob.glob(bib_glob)):
+        if (shard and not in_shard(bib_file, shard)):
+            continue
+        fingerprint = file_fingerprint(bib_file)
+        if (bib_file in manifest['files']):
+            problem = entry_problem(manifest['files'][bib_file], fingerprint, manifest['stackscores_sha1'])
+            if (problem is None):
+                logging.info("Skipping %s, already done" % (bib_file))
+                continue
+            logging.info("Redoing %s, %s" % (bib_file, problem))
+        result = process_file(bib_file, namespace_manager)
+        if (result is None):
+            failed.append(bib_file)
+            continue
+        (ss_anno_file, n) = result
+        manifest['files'][bib_file] = {'fingerprint': fingerprint,
+                                       'stackscores_sha1': manifest['stackscores_sha1'],
+                                       'output': ss_anno_file,
+                                       'count': n,
+                                       'size': os.path.getsize(ss_anno_file),
+                                       'sha1': file_checksum(ss_anno_file)}
+        write_manifest(manifest, manifest_file)
+        records += n
         elapsed = (time.time() - start_time)
         logging.info("-- %.1fs elapsed, %d records, overall rate %.2frecords/s" % (elapsed,records,records/elapsed))
+if (failed):
+    logging.error("Failed to write annotations for %d files, not recorded in %s: %s" %
+                  (len(failed), manifest_file, ', '.join(failed)))
+    sys.exit(1)
 logging.info("Done")
-
@@ -0,0 +1,281 @@
+"""
+Reference distributions over StackScore 1..100 and cumulative target counts.
+
+A reference distribution gives the fraction of items that should get each
+StackScore. It is built from one or more source distributions of StackScores
+(such as analysis/harvard_stackscore_distribution.dat), optionally blended with
+weights and smoothed, and written as a text table like reference_dist.dat.
+
+For normalization the reference distribution is used as the integer cumulative
+target counts from StackScore 100 down, for a given total number of items. These
+are computed once and may be persisted in a cache directory as compressed numpy
+.npz files, keyed by the checksum of the reference file and the total number of
+items, so that repeated scoring runs can use them directly as arrays.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy
+
+
+def read_source_dist(file):
+    """Read in a source distribution, return (dist, total)
+
+    dist is a dict of number of records by StackScore and total is the total
+    number of records. Two file formats are accepted, the format being taken
+    from the number of columns. Either the 3 column format of the Harvard
+    distribution, where a header line of column names may be left uncommented:
+
+    # Distribution of StackScore values at Harvard, 2015-06-24
+    #
+    #record_count     stackscore        fraction_of_records
+    13560805        1       0.98078307
+    76281   2       0.00551701
+    ...
+    140     100     0.00001013
+
+    or the 5 column format of StackScore distributions written by write_dist()
+    in parse_cul_usage_data.py, where col1 is the StackScore and col2 the
+    number of records:
+
+    # Distribution stackscore_dist.dat
+    # ...
+    1	6932376	2.9552440	0.9807831	-
+    2	38996	0.0166238	0.0055171	-
+    ...
+    """
+    fh = open(file, 'r')
+    dist = {}
+    total = 0
+    columns = None
+    for line in fh.readlines():
+        if (line.startswith('#') or line.strip()==''):
+            continue
+        fields = line.split()
+        if (fields == ['record_count','stackscore','fraction_of_records']):
+            continue
+        if (columns is None):
+            columns = len(fields)
+        if (len(fields) != columns or columns not in (3,5)):
+            raise Exception("Unrecognized format for source distribution %s, expected 3 columns "
+                            "(record_count stackscore fraction) or 5 columns as from write_dist() "
+                            "(stackscore count ...), got: %s" % (file,line.strip()))
+        try:
+            if (columns == 3):
+                (count,stackscore) = (int(fields[0]),int(fields[1]))
+            else:
+                (stackscore,count) = (int(fields[0]),int(fields[1]))
+        except ValueError:
+            raise Exception("Bad StackScore or count in source distribution %s: %s" % (file,line.strip()))
+        if (stackscore<1 or stackscore>100):
+            raise Exception("Stackscore out of range in: %s" % line)
+        if (stackscore in dist):
+            raise Exception("Repeated StackScore %d in source distribution %s" % (stackscore,file))
+        dist[stackscore] = count
+        total += count
+    fh.close()
+    if (total == 0):
+        raise Exception("No records in source distribution %s" % (file))
+    return(dist,total)
+
+
+def blend_dists(sources, weights=None):
+    """Blend source distributions into one reference distribution
+
+    sources is a list of (dist, total) pairs from read_source_dist() and
+    weights a list of the same length (default equal weights). Returns a dict
+    of fraction by StackScore for 1..100.
+    """
+    if (weights is None):
+        weights = [1.0] * len(sources)
+    if (len(weights) != len(sources)):
+        raise Exception("Got %d weights for %d source distributions" % (len(weights),len(sources)))
+    weight_sum = float(sum(weights))
+    fractions = {}
+    for ss in range(1,101):
+        fractions[ss] = sum([w / weight_sum * float(dist.get(ss,0)) / total
+                             for ((dist, total), w) in zip(sources, weights)])
+    return fractions
+
+
+def smooth_dist(fractions, window):
+    """Smooth fractions over StackScores 2..100 with a centered moving average
+
+    The window is truncated at the ends of the range. StackScore 1, which holds
+    all items with little or no usage, is left unchanged and the smoothed
+    fractions for 2..100 are rescaled to keep their original sum.
+    """
+    scores = range(2,101)
+    values = numpy.array([fractions[ss] for ss in scores])
+    half = window // 2
+    smoothed = numpy.array([values[max(0,j-half):j+half+1].mean() for j in range(len(values))])
+    if (smoothed.sum() > 0):
+        smoothed *= values.sum() / smoothed.sum()
+    result = dict(fractions)
+    for (ss, value) in zip(scores, smoothed.tolist()):
+        result[ss] = value
+    return result
+
+
+def write_reference_dist(fractions, fh, description):
+    """Write reference distribution table to open file fh"""
+    fh.write("# Reference distribution over StackScore 1..100\n")
+    for line in description:
+        fh.write("# %s\n" % (line))
+    fh.write("#\n#stackscore fraction\n")
+    for ss in range(1,101):
+        fh.write("%d\t%.8f\n" % (ss,fractions[ss]))
+
+
+def cumulative_targets(dist, total_items):
+    """Integer cumulative target counts for StackScores 100, 99, ... 1
+
+    Element k is the number of items that should have StackScore 100-k or
+    higher. The cumulative fractions are summed in the same order as the
+    StackScore matching always has, from 100 down.
+    """
+    targets = numpy.zeros(100, dtype=numpy.int64)
+    ss_frac = 0.0
+    for k in range(100):
+        ss_frac += dist[100-k]
+        targets[k] = int(ss_frac*total_items)
+    return targets
+
+
+class ReferenceDist(dict):
+    """
+    Reference distribution as dict of fraction by StackScore, with cumulative
+    target counts computed once per total number of items and optionally cached
+    on disk in cache_dir
+    """
+
+    def __init__(self, file, cache_dir=None):
+        super(ReferenceDist, self).__init__()
+        self.file = file
+        self.cache_dir = cache_dir
+        self.md5 = None
+        self.cumulative = {}
+
+    def read(self):
+        """Read reference distribution from self.file
+
+        File format has # for comment lines then data:
+
+        #stackscore fraction
+        100 0.00001013
+        99 0.00001013
+        98 0.00003045
+        ...
+        """
+        logging.info("Reading reference distribution from %s..." % (self.file))
+        fh = open(self.file,'rb')
+        data = fh.read()
+        fh.close()
+        self.md5 = hashlib.md5(data).hexdigest()
+        total = 0.0
+        for line in data.decode('utf-8').splitlines():
+            if (line.startswith('#') or not line.strip()):
+                continue
+            (stackscore, fraction)= line.split()
+            fraction = float(fraction)
+            self[int(stackscore)] = fraction
+            total += fraction
+        if (abs(1.0-total)>0.000001):
+            logging.warning("Expected distribution from %s to sum to 1.0, got %f" % (self.file,total))
+        return self
+
+    def cache_file(self, total_items):
+        """Name of cache file for cumulative targets for total_items"""
+        return os.path.join(self.cache_dir, "%s.cum%d.npz" % (os.path.basename(self.file),total_items))
+
+    def targets(self, total_items):
+        """Cumulative target counts for total_items, see cumulative_targets()
+
+        Uses the in-memory copy if already computed, else the cache file if there
+        is one made from the same reference file, else computes them and writes
+        the cache file (via temporary file and rename) if there is a cache_dir,
+        creating cache_dir if necessary.
+        """
+        if (total_items in self.cumulative):
+            return self.cumulative[total_items]
+        cache_file = self.cache_file(total_items) if (self.cache_dir) else None
+        if (cache_file and os.path.exists(cache_file)):
+            cache = numpy.load(cache_file)
+            source_md5 = cache['source_md5'].tolist()
+            if (isinstance(source_md5, bytes)):
+                # written by Python 2
+                source_md5 = source_md5.decode('ascii')
+            if (source_md5 == self.md5 and int(cache['total_items']) == total_items):
+                logging.info("Read cumulative reference targets from %s" % (cache_file))
+                self.cumulative[total_items] = cache['targets']
+                return self.cumulative[total_items]
+            logging.warning("Ignoring stale cumulative reference cache %s" % (cache_file))
+        targets = cumulative_targets(self, total_items)
+        self.cumulative[total_items] = targets
+        if (cache_file):
+            if (not os.path.isdir(self.cache_dir)):
+                os.makedirs(self.cache_dir)
+            (fd, tmp_file) = tempfile.mkstemp(suffix='.npz', dir=self.cache_dir)
+            fh = os.fdopen(fd, 'wb')
+            numpy.savez_compressed(fh, targets=targets, total_items=numpy.array(total_items),
+                                   source_md5=numpy.array(self.md5))
+            fh.close()
+            os.rename(tmp_file, cache_file)
+            logging.info("Wrote cumulative reference targets to %s" % (cache_file))
+        return targets
+
+
+def read_reference_dist(file, cache_dir=None):
+    """Read reference distribution from file, return ReferenceDist"""
+    return ReferenceDist(file, cache_dir).read()
+
+
+class CumulativeMatcher(object):
+    """
+    Class to do match_cumulative() incrementally over successive arrays of counts
+
+    Carries the number of raw scores and items seen so far and the running
+    minimum of j_m - m between calls, so that the counts may be read a chunk at
+    a time in order of descending raw score.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.num_scores = 0
+        self.num_items = 0
+        self.lowest = 0
+
+    def match(self, counts):
+        """Return array of StackScores for next counts, see match_cumulative()"""
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        if (len(counts)==0):
+            return numpy.zeros(0, dtype=numpy.int64)
+        cumulative = self.num_items + numpy.cumsum(counts)
+        j = numpy.minimum(numpy.searchsorted(2*self.targets, 2*cumulative-counts, side='left'), 99)
+        i = numpy.arange(self.num_scores+1, self.num_scores+len(counts)+1)
+        lowest = numpy.minimum(self.lowest, numpy.minimum.accumulate(j-i))
+        self.num_scores += len(counts)
+        self.num_items = cumulative[-1]
+        self.lowest = lowest[-1]
+        return 100 - (i + lowest)
+
+
+def match_cumulative(counts, targets):
+    """Assign StackScores to distinct raw scores given cumulative target counts
+
+    counts is an array of the number of items with each distinct raw score, in
+    order of descending raw score. Returns an array of the StackScore for each.
+
+    This gives exactly the result of walking down from StackScore 100, moving to
+    the next lower StackScore (at most one step per raw score, never below 1)
+    when adding the items for a raw score would overshoot the cumulative target
+    by more than it undershoots. Raw score i would step if twice the target is
+    less than m_i = c_(i-1) + c_i, where c are the cumulative counts. So with
+    j_i the number of targets for which that holds, found with searchsorted, the
+    number of steps taken is k_i = min(k_(i-1)+1, j_i) = i + min(0, min(j_m - m)
+    for m <= i).
+    """
+    return CumulativeMatcher(targets).match(counts)